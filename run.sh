@@ -17,6 +17,7 @@ python src/run_evaluation.py \
     --use_llm_equivalence \
     --eval_task GAIA \
     --version v1 \
+    --concurrency 1 \
     # --advanced_reasoning_model google/gemini-2.5-flash \
     # --advanced_reasoning_model_base_url https://openrouter.ai/api/v1 \
     # --advanced_reasoning_model_api_key openrouter-api-key
@@ -1,27 +1,78 @@
 from config import Configuration
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+import asyncio
+import threading
+import weakref
+import httpx
 
-def get_reasoning_agent(config: Configuration, use_advanced_reasoning: bool = True) -> tuple[OpenAI, str]:
+# Process-wide client registry, so the connection pool (and its TCP/TLS setup)
+# is shared by every node call that talks to the same endpoint.
+_clients: dict[tuple, OpenAI] = {}
+# keyed weakly by event loop, so a closed loop's clients go with it and a later loop
+# that reuses its id() never gets a client bound to the dead loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple, AsyncOpenAI]]" = weakref.WeakKeyDictionary()
+_loopless_async_clients: dict[tuple, AsyncOpenAI] = {}
+_clients_lock = threading.Lock()
+
+def _get_limits(config: Configuration) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=config.llm_max_connections,
+        max_keepalive_connections=config.llm_max_keepalive_connections,
+        keepalive_expiry=config.llm_keepalive_expiry,
+    )
+
+def get_client(config: Configuration, base_url: str, api_key: str) -> OpenAI:
+    """Return the shared OpenAI client for (base_url, api_key), creating it on first use."""
+    key = (base_url, api_key)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = OpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                http_client=httpx.Client(limits=_get_limits(config), timeout=config.llm_timeout),
+            )
+        return _clients[key]
+
+def get_async_client(config: Configuration, base_url: str, api_key: str) -> AsyncOpenAI:
+    """Async twin of get_client. Clients are also keyed by the running event loop,
+    since an httpx.AsyncClient cannot be shared across loops."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    key = (base_url, api_key)
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {}) if loop is not None else _loopless_async_clients
+        if key not in clients:
+            clients[key] = AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                http_client=httpx.AsyncClient(limits=_get_limits(config), timeout=config.llm_timeout),
+            )
+        return clients[key]
+
+def _get_reasoning_endpoint(config: Configuration, use_advanced_reasoning: bool) -> tuple[str, str, str]:
     if config.advanced_reasoning_model and use_advanced_reasoning:
-        llm = OpenAI(
-            base_url=config.advanced_reasoning_model_base_url,
-            api_key=config.advanced_reasoning_model_api_key,
-        )
-        llm_name = config.advanced_reasoning_model
-    else:
-        llm = OpenAI(
-            base_url=config.reasoning_model_base_url,
-            api_key=config.reasoning_model_api_key,
-        )
-        llm_name = config.reasoning_model
+        return config.advanced_reasoning_model_base_url, config.advanced_reasoning_model_api_key, config.advanced_reasoning_model
+    return config.reasoning_model_base_url, config.reasoning_model_api_key, config.reasoning_model
+
+def get_reasoning_agent(config: Configuration, use_advanced_reasoning: bool = True) -> tuple[OpenAI, str]:
+    base_url, api_key, llm_name = _get_reasoning_endpoint(config, use_advanced_reasoning)
+    llm = get_client(config, base_url, api_key)
     return llm, llm_name
 
 def get_auxiliary_agent(config: Configuration) -> OpenAI:
-    llm = OpenAI(
-        base_url=config.auxiliary_model_base_url,
-        api_key=config.auxiliary_model_api_key,
-    )
+    llm = get_client(config, config.auxiliary_model_base_url, config.auxiliary_model_api_key)
+    return llm
+
+def get_async_reasoning_agent(config: Configuration, use_advanced_reasoning: bool = True) -> tuple[AsyncOpenAI, str]:
+    base_url, api_key, llm_name = _get_reasoning_endpoint(config, use_advanced_reasoning)
+    llm = get_async_client(config, base_url, api_key)
+    return llm, llm_name
+
+def get_async_auxiliary_agent(config: Configuration) -> AsyncOpenAI:
+    llm = get_async_client(config, config.auxiliary_model_base_url, config.auxiliary_model_api_key)
     return llm
 
 
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+
+class CompletionCache:
+    """On-disk LLM completion cache with size-bounded LRU eviction.
+
+    Entries are keyed by a hash of the model, prompt and every sampling
+    parameter, so a hit is only returned for an identical request.
+    """
+
+    def __init__(self, path: str, max_size_mb: float = 1024):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                size INTEGER,
+                last_access REAL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON completions (last_access)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(**request) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key: str, value: str):
+        size = len(value.encode("utf-8"))
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO completions (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time())
+            )
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_size:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM completions ORDER BY last_access").fetchall():
+            if total <= self.max_size:
+                break
+            self.conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size_mb": round(size / 1024 / 1024, 2),
+        }
+
+
+class EvidenceCache:
+    """On-disk cache of the evidence refined from a page, shared across steps and questions.
+
+    Entries are keyed by the hash of the page content, the refinement model and the
+    normalized search intention. When an intention embedding is given, an entry for the same
+    page and model whose intention embedding is at least `similarity` cosine-close is also a
+    hit. A page found unhelpful is cached too, as evidence None. The least recently used
+    entries are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000, similarity: float = 0.95):
+        self.path = path
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS evidence (
+                content_hash TEXT,
+                model TEXT,
+                intention TEXT,
+                embedding BLOB,
+                evidence TEXT,
+                last_access REAL,
+                PRIMARY KEY (content_hash, model, intention)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_evidence_last_access ON evidence (last_access)")
+        self.conn.commit()
+
+    @staticmethod
+    def normalize_intention(intention: str) -> str:
+        return " ".join(intention.lower().split())
+
+    @staticmethod
+    def hash_content(content: str) -> str:
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, content: str, model: str, intention: str, embedding: Optional[np.ndarray] = None) -> tuple[bool, Optional[str]]:
+        """
+        Returns:
+            tuple: (found, evidence), evidence being None for a page found unhelpful
+        """
+        content_hash = self.hash_content(content)
+        intention = self.normalize_intention(intention)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT intention, embedding, evidence FROM evidence WHERE content_hash = ? AND model = ?",
+                (content_hash, model)
+            ).fetchall()
+            match = next((row for row in rows if row[0] == intention), None)
+            if match is not None:
+                self.hits += 1
+            elif embedding is not None:
+                candidates = [row for row in rows if row[1] is not None]
+                if candidates:
+                    similarities = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in candidates]) @ embedding
+                    if similarities.max() >= self.similarity:
+                        match = candidates[int(similarities.argmax())]
+                        self.near_hits += 1
+            if match is None:
+                self.misses += 1
+                return False, None
+            self.conn.execute(
+                "UPDATE evidence SET last_access = ? WHERE content_hash = ? AND model = ? AND intention = ?",
+                (time.time(), content_hash, model, match[0])
+            )
+            self.conn.commit()
+            return True, match[2]
+
+    def put(self, content: str, model: str, intention: str, evidence: Optional[str], embedding: Optional[np.ndarray] = None):
+        blob = np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO evidence (content_hash, model, intention, embedding, evidence, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.hash_content(content), model, self.normalize_intention(intention), blob, evidence, time.time())
+            )
+            excess = self.conn.execute("SELECT COUNT(*) FROM evidence").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.conn.execute(
+                    "DELETE FROM evidence WHERE rowid IN (SELECT rowid FROM evidence ORDER BY last_access LIMIT ?)",
+                    (excess,)
+                )
+                self.evictions += excess
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM evidence").fetchone()[0]
+        total = self.hits + self.near_hits + self.misses
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.near_hits) / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+        }
+
+
+completion_cache: Optional[CompletionCache] = None
+
+def set_completion_cache(cache: Optional[CompletionCache]):
+    """Enable (or with None, disable) the process-wide completion cache."""
+    global completion_cache
+    completion_cache = cache
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    return completion_cache
+
+evidence_cache: Optional[EvidenceCache] = None
+
+def set_evidence_cache(cache: Optional[EvidenceCache]):
+    """Enable (or with None, disable) the process-wide evidence cache."""
+    global evidence_cache
+    evidence_cache = cache
+
+def get_evidence_cache() -> Optional[EvidenceCache]:
+    return evidence_cache
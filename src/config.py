@@ -1,9 +1,10 @@
 import os
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Any, Optional
 
 from langchain_core.runnables import RunnableConfig
 import argparse
+import threading
 
 class ConfigParser:
     def __init__(self):
@@ -25,16 +26,62 @@ class ConfigParser:
         self.parser.add_argument("--max_retries", type=int, default=3)
         self.parser.add_argument("--version", type=str, default="v1")
         self.parser.add_argument("--search_topk", type=int, default=10)
+        self.parser.add_argument("--search_timeout", type=float, default=60.0)
+        self.parser.add_argument("--evidence_early_stop", type=int, default=0)
+        self.parser.add_argument("--refine_workers", type=int, default=8)
+        self.parser.add_argument("--near_duplicate_threshold", type=float, default=0)
+        self.parser.add_argument("--refine_pack_tokens", type=int, default=0)
+        self.parser.add_argument("--rerank_top_passages", type=int, default=0)
+        self.parser.add_argument("--rerank_top_pages", type=int, default=0)
+        self.parser.add_argument("--rerank_passage_chars", type=int, default=1000)
+        self.parser.add_argument("--rerank_embedding_model", type=str, default="")
+        self.parser.add_argument("--rerank_embedding_base_url", type=str, default="")
+        self.parser.add_argument("--rerank_embedding_api_key", type=str, default="")
+        self.parser.add_argument("--tool_dispatch", type=str, default="auxiliary", choices=["auxiliary", "local"])
         self.parser.add_argument("--use_llm_equivalence", action='store_true', default=False)
         self.parser.add_argument("--use_experience", action='store_true', default=False)
         self.parser.add_argument("--use_reflection", action='store_true', default=False)
+        self.parser.add_argument("--concurrency", type=int, default=1)
+        self.parser.add_argument("--ordered_output", action='store_true', default=False)
+        self.parser.add_argument("--resume_file", type=str, default="")
+        self.parser.add_argument("--checkpoint_db", type=str, default="")
+        self.parser.add_argument("--reasoning_token_budget", type=int, default=32000)
+        self.parser.add_argument("--compaction_threshold", type=float, default=0.8)
+        self.parser.add_argument("--reasoning_tokenizer", type=str, default="")
+        self.parser.add_argument("--code_workers", type=int, default=4)
+        self.parser.add_argument("--code_timeout", type=float, default=30)
+        self.parser.add_argument("--code_memory_mb", type=int, default=2048)
+        self.parser.add_argument("--measure_prefix_cache", action='store_true', default=False)
+        self.parser.add_argument("--completion_cache", type=str, default="")
+        self.parser.add_argument("--completion_cache_size_mb", type=float, default=1024)
+        self.parser.add_argument("--evidence_cache", type=str, default="")
+        self.parser.add_argument("--evidence_cache_max_entries", type=int, default=100000)
+        self.parser.add_argument("--evidence_cache_similarity", type=float, default=0.95)
+        self.parser.add_argument("--llm_max_connections", type=int, default=100)
+        self.parser.add_argument("--llm_max_keepalive_connections", type=int, default=20)
+        self.parser.add_argument("--llm_keepalive_expiry", type=float, default=60.0)
+        self.parser.add_argument("--llm_timeout", type=float, default=600.0)
         self.args = self.parser.parse_args()
 
 
 
+_cli_args: Optional[dict[str, Any]] = None
+_default_config: Optional["Configuration"] = None
+_config_cache: dict[tuple, "Configuration"] = {}
+_config_lock = threading.Lock()
+
+def get_cli_args() -> dict[str, Any]:
+    """Parse the command line once per process."""
+    global _cli_args
+    if _cli_args is None:
+        _cli_args = dict(ConfigParser().args.__dict__)
+    return _cli_args
+
 class Configuration(BaseModel):
     """The configuration for the agent."""
 
+    model_config = ConfigDict(frozen=True)
+
     reasoning_model: str = Field(
         default="",
         metadata={
@@ -101,6 +148,50 @@ class Configuration(BaseModel):
         default=10,
         metadata={"description": "The number of search results to return."},
     )
+    search_timeout: float = Field(
+        default=60.0,
+        metadata={"description": "The timeout in seconds for each search API and cache search call."},
+    )
+    evidence_early_stop: int = Field(
+        default=0,
+        metadata={"description": "Stop a search step once this many evidence blocks are found (0 to refine every page)."},
+    )
+    refine_workers: int = Field(
+        default=8,
+        metadata={"description": "The maximum number of page refinement calls running at a time in a search step."},
+    )
+    near_duplicate_threshold: float = Field(
+        default=0,
+        metadata={"description": "Estimated shingle Jaccard similarity above which a page is dropped as a near duplicate of a kept page, e.g. 0.8 (0 to disable)."},
+    )
+    refine_pack_tokens: int = Field(
+        default=0,
+        metadata={"description": "Pack pages into shared refinement prompts of up to this many page tokens (0 for one prompt per page)."},
+    )
+    rerank_top_passages: int = Field(
+        default=0,
+        metadata={"description": "Passages kept from each page before refinement (0 to refine whole pages)."},
+    )
+    rerank_top_pages: int = Field(
+        default=0,
+        metadata={"description": "The maximum number of pages refined per search step, the most relevant across all search calls of the step once they all returned (0 for no limit)."},
+    )
+    rerank_passage_chars: int = Field(
+        default=1000,
+        metadata={"description": "The approximate length in characters of a reranked passage."},
+    )
+    rerank_embedding_model: str = Field(
+        default="",
+        metadata={"description": "The embedding model (e.g. bge-m3) added to BM25 when reranking passages (empty for BM25 only)."},
+    )
+    rerank_embedding_base_url: str = Field(
+        default="",
+        metadata={"description": "The base URL of the OpenAI-compatible embedding endpoint used for reranking."},
+    )
+    rerank_embedding_api_key: str = Field(
+        default="",
+        metadata={"description": "The API key of the embedding endpoint used for reranking."},
+    )
     use_web_search: bool = Field(
         default=False,
         metadata={"description": "Whether to use the web search."},
@@ -137,15 +228,126 @@ class Configuration(BaseModel):
         default="v1",
         metadata={"description": "The version of the evaluation."},
     )
+    concurrency: int = Field(
+        default=1,
+        metadata={"description": "The number of questions to evaluate concurrently."},
+    )
+    ordered_output: bool = Field(
+        default=False,
+        metadata={"description": "Whether to write evaluation results in dataset order."},
+    )
+    resume_file: str = Field(
+        default="",
+        metadata={"description": "An existing evaluation JSONL to resume; successful questions in it are skipped."},
+    )
+    checkpoint_db: str = Field(
+        default="",
+        metadata={"description": "The SQLite file for LangGraph checkpoints, used to resume interrupted questions mid-graph."},
+    )
+    reasoning_token_budget: int = Field(
+        default=32000,
+        metadata={"description": "The prompt size in tokens at which the reasoning model is asked for its final answer."},
+    )
+    compaction_threshold: float = Field(
+        default=0.8,
+        metadata={"description": "The fraction of the token budget above which older reasoning context is compacted."},
+    )
+    reasoning_tokenizer: str = Field(
+        default="",
+        metadata={"description": "The Hugging Face tokenizer of the reasoning model used to count prompt tokens (tiktoken cl100k_base if empty)."},
+    )
+    code_workers: int = Field(
+        default=4,
+        metadata={"description": "The number of pre-warmed sandbox processes for the calculator/code tool."},
+    )
+    code_timeout: float = Field(
+        default=30,
+        metadata={"description": "The time limit in seconds for each code execution."},
+    )
+    tool_dispatch: str = Field(
+        default="auxiliary",
+        metadata={"description": "How the router picks the tool for a help request: 'auxiliary' asks the auxiliary model; 'local' parses the tool call the reasoning model writes inside <help>, falling back to a rule-based classifier and then the auxiliary model."},
+    )
+    code_memory_mb: int = Field(
+        default=2048,
+        metadata={"description": "The address space limit in MB of each sandbox process."},
+    )
+    measure_prefix_cache: bool = Field(
+        default=False,
+        metadata={"description": "Whether to report the reasoning server's prefix cache hit rate during evaluation."},
+    )
+    completion_cache: str = Field(
+        default="",
+        metadata={"description": "The SQLite file of the on-disk LLM completion cache (empty to disable)."},
+    )
+    completion_cache_size_mb: float = Field(
+        default=1024,
+        metadata={"description": "The size bound of the completion cache in MB, enforced by LRU eviction."},
+    )
+    evidence_cache: str = Field(
+        default="",
+        metadata={"description": "Path of the SQLite evidence cache shared across steps and questions (empty to disable)."},
+    )
+    evidence_cache_max_entries: int = Field(
+        default=100000,
+        metadata={"description": "The maximum number of entries kept in the evidence cache, least recently used evicted first."},
+    )
+    evidence_cache_similarity: float = Field(
+        default=0.95,
+        metadata={"description": "Cosine similarity at which a cached search intention matches, using the rerank embedding model."},
+    )
+    llm_max_connections: int = Field(
+        default=100,
+        metadata={"description": "The maximum number of connections in each shared LLM client pool."},
+    )
+    llm_max_keepalive_connections: int = Field(
+        default=20,
+        metadata={"description": "The maximum number of idle keep-alive connections in each shared LLM client pool."},
+    )
+    llm_keepalive_expiry: float = Field(
+        default=60.0,
+        metadata={"description": "The seconds an idle keep-alive connection is kept open."},
+    )
+    llm_timeout: float = Field(
+        default=600.0,
+        metadata={"description": "The timeout in seconds for LLM requests."},
+    )
+    @classmethod
+    def set_default(cls, config: Optional["Configuration"]) -> None:
+        """Use `config` instead of the command line and environment for every
+        subsequent from_runnable_config call, e.g. when embedded in a server.
+        Passing None restores command line resolution."""
+        global _default_config
+        with _config_lock:
+            _default_config = config
+            _config_cache.clear()
+
     @classmethod
     def from_runnable_config(
         cls, config: Optional[RunnableConfig] = None
     ) -> "Configuration":
-        """Create a Configuration instance from a RunnableConfig."""
+        """Create a Configuration instance from a RunnableConfig.
+
+        The result is memoized per set of configurable values, so graph nodes
+        can call this on every step without re-parsing the command line.
+        """
         configurable = (
             config["configurable"] if config and "configurable" in config else {}
         )
-        parser = ConfigParser()
+        key = tuple(
+            (name, repr(configurable[name]))
+            for name in cls.model_fields.keys() if name in configurable
+        )
+        with _config_lock:
+            if key not in _config_cache:
+                _config_cache[key] = cls._resolve(configurable)
+            return _config_cache[key]
+
+    @classmethod
+    def _resolve(cls, configurable: dict[str, Any]) -> "Configuration":
+        if _default_config is not None:
+            overrides = {k: v for k, v in configurable.items() if k in cls.model_fields}
+            return cls(**{**_default_config.model_dump(), **overrides})
 
         # Get raw values from environment or config
         raw_values: dict[str, Any] = {
@@ -155,7 +357,7 @@ class Configuration(BaseModel):
 
         # Filter out None values
         values = {k: v for k, v in raw_values.items() if v is not None}
-        for k, v in parser.args.__dict__.items():
+        for k, v in get_cli_args().items():
             values[k] = v
 
         return cls(**values)
@@ -0,0 +1,91 @@
+import re
+import zlib
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import numpy as np
+
+# Query parameters that only track the visit and never change the page
+TRACKING_PARAMS = {"gclid", "fbclid", "msclkid", "dclid", "yclid", "igshid", "mc_cid", "mc_eid", "ref", "ref_src", "spm", "_ga", "_gl"}
+
+def canonicalize_url(url: str) -> str:
+    """
+    Canonical form of a URL, so variants of the same page share one key.
+
+    http and https, a leading 'www.', default ports, a trailing slash, the fragment and
+    tracking parameters (utm_* and the like) are ignored; the other parameters are sorted.
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    if not parts.netloc:
+        return url
+    scheme = parts.scheme.lower()
+    if scheme in ("http", "https"):
+        scheme = "https"
+    host = parts.hostname or ""
+    if host.startswith("www."):
+        host = host[4:]
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host if port in (None, 80, 443) else f"{host}:{port}"
+    path = re.sub(r"/{2,}", "/", parts.path).rstrip("/")
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith("utm_") and key.lower() not in TRACKING_PARAMS
+    ))
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+class PageDeduplicator:
+    """
+    Detect near-duplicate page contents (mirrors, syndicated copies) with MinHash over word
+    shingles, bucketed by LSH bands so each page is only compared with likely duplicates.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, bands: int = 16, shingle_size: int = 5):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        # a < 2^31 and 32-bit shingle hashes keep (a * x + b) within uint64
+        rng = np.random.RandomState(1)
+        self.a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+        self.signatures = []
+        self.buckets = {}
+
+    def signature(self, content: str) -> Optional[np.ndarray]:
+        words = re.findall(r"\w+", content.lower())
+        if not words:
+            return None
+        size = min(self.shingle_size, len(words))
+        shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        mixed = (hashes[:, None] * self.a + self.b) % np.uint64(_MERSENNE_PRIME)
+        return (mixed & np.uint64(_MAX_HASH)).min(axis=0)
+
+    def _band_keys(self, signature: np.ndarray) -> list:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def is_duplicate(self, content: str) -> bool:
+        """Whether `content` nearly duplicates a page added before; if not, the page is added."""
+        signature = self.signature(content)
+        if signature is None:
+            return False
+        keys = self._band_keys(signature)
+        candidates = {i for key in keys for i in self.buckets.get(key, ())}
+        for i in candidates:
+            if np.mean(self.signatures[i] == signature) >= self.threshold:
+                return True
+        for key in keys:
+            self.buckets.setdefault(key, []).append(len(self.signatures))
+        self.signatures.append(signature)
+        return False
@@ -0,0 +1,101 @@
+import json
+import re
+from typing import Optional
+
+from prompts import tool_dict
+from schema import tool_result
+
+TOOL_CALL_PATTERN = re.compile(r"<tool_call>(.*?)(?:</tool_call>|$)", re.S)
+CODE_BLOCK_PATTERN = re.compile(r"```(?:python|py)?\s*\n(.*?)```", re.S)
+EXPRESSION_PATTERN = re.compile(r"[\d\s.+\-*/()%^]+")
+# requests in these terms may need a calculation or code, which only the auxiliary model can write
+COMPUTE_PATTERN = re.compile(
+    r"\b(calculat\w*|comput\w*|convert\w*|sum|average|mean|median|percent\w*|ratio|solve|equation|"
+    r"integral|derivative|probability|code|python|script|program|simulat\w*)\b|[=%]",
+    re.I,
+)
+REQUEST_PREFIX_PATTERN = re.compile(
+    r"^(?:i (?:need|want|would like) to (?:find(?: out)?|know|search(?: for)?|look up|get|verify|confirm|check)|"
+    r"(?:please|can you|could you)|search(?: the (?:internet|web))?(?: for)?|look up|find(?: out)?|"
+    r"help me (?:find|search(?: for)?))\s+",
+    re.I,
+)
+MAX_LOCAL_QUERIES = 5
+MAX_LOCAL_QUERY_WORDS = 30
+
+def split_tool_call(help_content: str) -> tuple[str, Optional[dict]]:
+    """
+    Split a help request into its natural-language intention and the structured tool call
+    the reasoning model wrote inside it, if any.
+
+    The call is a <tool_call>{"tool": ..., "content": [...]}</tool_call> block, or the whole
+    request when it is such a JSON object. A call that does not parse, names an unknown tool
+    or has no content is ignored. The intention never includes the <tool_call> block; it is
+    empty if nothing else was written and the call did not parse.
+
+    Returns:
+        tuple: (intention, {'tool': str, 'content': list[str]} or None)
+    """
+    match = TOOL_CALL_PATTERN.search(help_content)
+    intention = TOOL_CALL_PATTERN.sub("", help_content).strip() if match else help_content.strip()
+    raw = match.group(1) if match else help_content
+    call = None
+    content = []
+    start, end = raw.find("{"), raw.rfind("}")
+    if start != -1 and end > start:
+        try:
+            # strict=False accepts code with literal newlines inside the JSON strings
+            data = json.loads(raw[start:end + 1], strict=False)
+            if isinstance(data, dict) and isinstance(data.get("content"), str):
+                data["content"] = [data["content"]]
+            parsed = tool_result(**data)
+            content = [item.strip() for item in parsed.content if item.strip()]
+            if parsed.tool in tool_dict and content:
+                call = {"tool": parsed.tool, "content": content}
+        except (ValueError, TypeError):
+            pass
+    if (not match and call is not None) or not intention:
+        # nothing but the call was written, so its queries or code stand for the intention;
+        # empty if the call did not parse either
+        intention = "; ".join(content)
+    return intention, call
+
+def has_tool_call(help_content: str) -> bool:
+    """Whether the help request contains a <tool_call> block, parsed or not."""
+    return TOOL_CALL_PATTERN.search(help_content) is not None
+
+def classify_tool_request(help_content: str) -> Optional[dict]:
+    """
+    Pick the tool and its content for a natural-language help request with cheap rules.
+
+    A fenced code block goes to code_execution and a bare arithmetic expression to the
+    calculator. Requests that read like a calculation are left undecided; the others become
+    search queries, one per line or question, with request phrasing ("I need to find") removed.
+
+    Returns:
+        dict: {'tool': str, 'content': list[str]}, or None if the rules cannot decide
+    """
+    code = CODE_BLOCK_PATTERN.search(help_content)
+    if code and code.group(1).strip():
+        return {"tool": "code_execution", "content": [code.group(1).strip()]}
+
+    text = help_content.strip()
+    if EXPRESSION_PATTERN.fullmatch(text) and re.search(r"\d", text) and re.search(r"[+\-*/%^]", text):
+        return {"tool": "calculator", "content": [text.replace("^", "**")]}
+    if COMPUTE_PATTERN.search(text):
+        return None
+
+    queries = []
+    for line in text.splitlines():
+        for segment in re.split(r"(?<=\?)\s+", line):
+            segment = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", segment).strip()
+            previous = None
+            while previous != segment:
+                previous = segment
+                segment = REQUEST_PREFIX_PATTERN.sub("", segment)
+            segment = segment.rstrip(" .;:")
+            if segment and segment not in queries:
+                queries.append(segment)
+    if not queries or len(queries) > MAX_LOCAL_QUERIES or any(len(query.split()) > MAX_LOCAL_QUERY_WORDS for query in queries):
+        return None
+    return {"tool": "search", "content": queries}
@@ -4,6 +4,7 @@ import re
 import string
 from openai import OpenAI
 import os
+from cache import get_completion_cache
 def llm_evaluate_equivalence_single(
     client: OpenAI,
     question: str,
@@ -26,13 +27,21 @@ Are these answers equivalent? Please respond with "Correct" if they are equivale
 """
 
 
+    cache = get_completion_cache()
+    if cache is not None:
+        cache_key = cache.make_key(model=model_name, messages=[{"role": "user", "content": prompt}])
+
     for attempt in range(retry_limit):
         try:
-            chat_response = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": prompt}],
-            )
-            response_text = chat_response.choices[0].message.content.strip()
+            response_text = cache.get(cache_key) if cache is not None else None
+            if response_text is None:
+                chat_response = client.chat.completions.create(
+                    model=model_name,
+                    messages=[{"role": "user", "content": prompt}],
+                )
+                response_text = chat_response.choices[0].message.content.strip()
+                if cache is not None:
+                    cache.put(cache_key, response_text)
             llm_judge = response_text.lower() == "correct" and \
                 not ("incorrect" in response_text.lower() or \
                         "wrong" in response_text.lower() or \
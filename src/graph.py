@@ -1,4 +1,4 @@
-from typing import Dict, List, TypedDict, Annotated
+from typing import Dict, List, Optional, TypedDict, Annotated
 from langgraph.graph import StateGraph, END, START
 from langgraph.prebuilt import ToolNode
 from langchain_core.messages import HumanMessage, AIMessage
@@ -12,9 +12,27 @@ from schema import reasoning_result, tool_result, reflection_result
 import json 
 from utils import *
 import requests
+import concurrent.futures
+import threading
 from itertools import chain
 import re
 from evaluation import llm_evaluate_equivalence_single
+from sandbox import get_code_executor
+from rerank import rerank_results, embed_texts
+from cache import get_evidence_cache
+from dedup import PageDeduplicator
+from dispatch import split_tool_call, has_tool_call, classify_tool_request
+
+search_session = requests.Session()
+
+def search_api(query: str, config: Configuration) -> dict:
+    response = search_session.get(
+        config.search_api_url,
+        params={"query": query, "topk": config.search_topk},
+        timeout=config.search_timeout,
+    )
+    response.raise_for_status()
+    return response.json()
 
 def cache_search(query: str, config: Configuration) -> str:
     cache_search_url = config.cache_search_url
@@ -22,69 +40,194 @@ def cache_search(query: str, config: Configuration) -> str:
         "query": query,
         "topk": config.cache_search_topk
     }
-    cache_search_response = requests.post(cache_search_url, json=cache_search_data)
+    cache_search_response = search_session.post(cache_search_url, json=cache_search_data, timeout=config.search_timeout)
     cache_search_response.raise_for_status()
     cache_search_result = cache_search_response.json()
     return cache_search_result
 
-def web_search(queries: list[str], reasoning_str: str, oringinal_task: str, search_intention: str, config: Configuration, first_search: bool) -> str:
-    if config.use_web_search:
-        results = {"results": []}
-        for q in queries[:3]: # limit the number of queries for web search to 3
-            search_url = f"{config.search_api_url}?query={q}&topk={config.search_topk}"
-            response = requests.get(search_url)
-            results["results"].extend(response.json()["results"])
+def submit_searches(executor: concurrent.futures.Executor, calls: list, config: Configuration) -> dict:
+    """Dispatch (search_fn, query, content_key) calls concurrently, returning each future with its call index and call."""
+    return {executor.submit(search_fn, query, config): (call_index, (search_fn, query, content_key)) for call_index, (search_fn, query, content_key) in enumerate(calls)}
+
+def search_response(future: concurrent.futures.Future, call: tuple) -> Optional[dict]:
+    """Response of a finished search call, or None if it failed or timed out, so one call cannot fail the whole step."""
+    search_fn, query, _ = call
+    try:
+        response = future.result()
+    except Exception as e:
+        print_color(f"{search_fn.__name__} failed for query {query}: {e}", bcolors.WARNING)
+        return None
+    print(f"{search_fn.__name__} results for {query}: ", len(response.get("results", [])))
+    return response
+
+def extract_evidence(refined_content: str):
+    """Return the <evidence> block of a refinement response, or None if the page was not helpful."""
+    if "</think>" not in refined_content:
+        res = refined_content
+        print_color(f"No think in refined_content: {refined_content}", bcolors.WARNING)
     else:
-        results = {"results": []}
-    print("web search results: ", len(results["results"]))
+        res = refined_content.split("</think>")[1]
+    if res.find("No helpful information found") != -1:
+        return None
+    return extract_between(res, "<evidence>", "</evidence>")
+
+def is_unhelpful(refined_content: str) -> bool:
+    """Whether a refinement response explicitly found no helpful information."""
+    return "No helpful information found" in refined_content.split("</think>")[-1]
+
+def extract_page_evidence(refined_content: str, num_pages: int) -> list[tuple[int, str]]:
+    """Return (page number, evidence) for every <evidence page="N"> block of a packed refinement response."""
+    res = refined_content.split("</think>")[-1]
+    page_evidence = []
+    for page, content in re.findall(r'<evidence\s+page\s*=\s*"?(\d+)"?\s*>(.*?)</evidence>', res, re.DOTALL):
+        if 1 <= int(page) <= num_pages and content.strip():
+            page_evidence.append((int(page), content.strip()))
+    return page_evidence
 
+def web_search(queries: list[str], reasoning_str: str, oringinal_task: str, search_intention: str, config: Configuration, first_search: bool) -> str:
+    """
+    Search and refine as a pipeline: each search call is dispatched concurrently, and each
+    new page is handed to the refinement prompt as soon as its search call returns.
+    With config.evidence_early_stop set, the step stops once that many evidence blocks are found,
+    and refinement calls still running are cancelled. At most config.refine_workers refinement
+    calls run at a time.
+    With config.rerank_top_passages set, each response's pages are cut down to their passages most
+    relevant to the search intention and queries, and refined most relevant first.
+    With config.rerank_top_pages set, pages are held until every search call returned, then merged
+    (keeping the richest copy of a page across calls), reranked together (or, without passage
+    reranking, kept in call order) and only the top pages are refined. Otherwise the first copy
+    of a page to arrive is kept.
+    With an evidence cache set up, pages already refined for the same (or, with the rerank
+    embedding model, a near-identical) search intention are not refined again.
+    With config.refine_pack_tokens set, each response's pages are packed into as few refinement
+    prompts as fit that many page tokens, and their evidence is attributed back to the pages.
+    """
+    # (search function, query, key holding the page text)
+    calls = []
+    if config.use_web_search:
+        calls += [(search_api, q, "context") for q in queries[:3]] # limit the number of queries for web search to 3
     if config.use_cache_search:
-        cache_search_result = {"results": []}
-        for q in queries:
-            cache_search_result["results"].extend(cache_search(q, config)["results"])
-    else:
-        cache_search_result = {"results": []}
-    print("cache search results: ", len(cache_search_result["results"]))
+        calls += [(cache_search, q, "content") for q in queries]
     if first_search:
-        task_cache_search = cache_search(oringinal_task, config)
-    else:
-        task_cache_search = {}
-
-    if not results and not cache_search_result:
-        raise ValueError("No search results found")
+        calls.append((cache_search, oringinal_task, "content"))
 
-    
-    web_search_result = process_and_merge_search_results(results, cache_search_result, task_cache_search, config, max_content_length=30000)
     prev_reasoning = truncate_reasoning_str(reasoning_str)
-    prompts = []
-
-    for i, result in enumerate(web_search_result):
-        refine_search_result_prompt = get_webpage_to_reasonchain_instruction(prev_reasoning, search_intention, oringinal_task, result["content"])
-
-        refine_search_result_prompt = qwen_think_template.format(prompt=refine_search_result_prompt)
-        prompts.append(refine_search_result_prompt)
-
+    rerank_query = " ".join([search_intention] + queries)
     agent, agent_name = get_reasoning_agent(config, use_advanced_reasoning=False)
-    content = batch_completion(
-        agent, 
-        agent_name, 
-        prompts, 
-        max_tokens=20000,
-    )
-    evidence = []
 
-    for refined_content in content:
-        if "</think>" not in refined_content:
-            res = refined_content
-            print_color(f"No think in refined_content: {refined_content}", bcolors.WARNING)
+    evidence_cache = get_evidence_cache()
+    intention_embedding = None
+    if evidence_cache is not None and config.rerank_embedding_model:
+        try:
+            intention_embedding = embed_texts([search_intention], config)[0]
+        except Exception as e:
+            print_color(f"Embedding the search intention failed, using exact evidence cache lookups: {e}", bcolors.WARNING)
+
+    search_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(calls), 1))
+    refine_executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.refine_workers)
+    # set on early stop, so refinement calls already running stop generating
+    refine_cancel = threading.Event()
+    search_futures = submit_searches(search_executor, calls, config)
+    refine_futures = {}
+    pending = set(search_futures)
+
+    seen_urls = set()
+    deduplicator = PageDeduplicator(config.near_duplicate_threshold) if config.near_duplicate_threshold else None
+    web_search_result = []
+    evidence = []
+    failed_calls = 0
+    # with a page cap, the pages of every call are held until all calls returned and capped together
+    held_results = {} if config.rerank_top_pages else None
+
+    def refine_pages(new_results):
+        page_indices = []
+        for result in new_results:
+            web_search_result.append(result)
+            if evidence_cache is not None:
+                found, res = evidence_cache.get(result["content"], agent_name, search_intention, intention_embedding)
+                if found:
+                    # refined for a matching intention in an earlier step or question
+                    if res is not None:
+                        evidence.append((len(web_search_result) - 1, res))
+                    continue
+            page_indices.append(len(web_search_result) - 1)
+        if config.refine_pack_tokens:
+            page_groups = pack_pages([web_search_result[i]["content"] for i in page_indices], config.refine_pack_tokens, config.reasoning_tokenizer)
+            page_groups = [[page_indices[i] for i in group] for group in page_groups]
         else:
-            res = refined_content.split("</think>")[1]
-        if res.find("No helpful information found") != -1:
-            continue
-        res = extract_between(res, "<evidence>", "</evidence>")
-        if res is not None:
-            evidence.append(res)
+            page_groups = [[i] for i in page_indices]
+        for group in page_groups:
+            if len(group) == 1:
+                refine_search_result_prompt = get_webpage_to_reasonchain_instruction(prev_reasoning, search_intention, oringinal_task, web_search_result[group[0]]["content"])
+            else:
+                refine_search_result_prompt = get_webpages_to_reasonchain_instruction(prev_reasoning, search_intention, oringinal_task, [web_search_result[i]["content"] for i in group])
+            refine_search_result_prompt = qwen_think_template.format(prompt=refine_search_result_prompt)
+            refine_future = refine_executor.submit(stream_completion, agent, agent_name, refine_search_result_prompt, max_tokens=20000, stream=False, cancel=refine_cancel)
+            refine_futures[refine_future] = group
+            pending.add(refine_future)
 
+    try:
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in search_futures:
+                    call_index, call = search_futures[future]
+                    content_key = call[2]
+                    response = search_response(future, call)
+                    if response is None:
+                        failed_calls += 1
+                        continue
+                    if held_results is not None:
+                        held_results[call_index] = [format_search_result(result, content_key, 30000) for result in response.get("results", []) if result.get("url")]
+                        continue
+                    new_results = merge_new_search_results(response, seen_urls, content_key, max_content_length=30000, deduplicator=deduplicator)
+                    if config.rerank_top_passages:
+                        new_results = rerank_results(new_results, rerank_query, config)
+                    refine_pages(new_results)
+                else:
+                    group = refine_futures[future]
+                    try:
+                        refined_content = future.result()
+                        if len(group) == 1:
+                            page_evidence = [(1, extract_evidence(refined_content))]
+                        else:
+                            page_evidence = extract_page_evidence(refined_content, len(group))
+                    except Exception as exc:
+                        print(f'Generated an exception: {exc}')
+                        continue
+                    refined = {page: res for page, res in page_evidence if res is not None}
+                    for page, res in refined.items():
+                        evidence.append((group[page - 1], res))
+                    if evidence_cache is not None:
+                        # pages are cached as unhelpful only when the model said so; pages missing
+                        # from a truncated or malformed response are refined again next time
+                        unhelpful = not refined and is_unhelpful(refined_content)
+                        for page, i in enumerate(group, 1):
+                            if page in refined or unhelpful:
+                                evidence_cache.put(web_search_result[i]["content"], agent_name, search_intention, refined.get(page), intention_embedding)
+
+            if held_results is not None and not any(future in search_futures for future in pending):
+                # merged at once, so the richest copy of a page across all calls is kept
+                step_results = select_new_results([result for call_index in sorted(held_results) for result in held_results[call_index]], seen_urls, deduplicator)
+                if config.rerank_top_passages:
+                    step_results = rerank_results(step_results, rerank_query, config)
+                refine_pages(step_results[:config.rerank_top_pages])
+                held_results = None
+
+            if config.evidence_early_stop and len(evidence) >= config.evidence_early_stop:
+                print_color(f"Found {len(evidence)} evidence blocks, skipping {len(pending)} pending calls", bcolors.OKBLUE)
+                break
+    finally:
+        refine_cancel.set()
+        search_executor.shutdown(wait=False, cancel_futures=True)
+        refine_executor.shutdown(wait=False, cancel_futures=True)
+
+    if calls and failed_calls == len(calls):
+        raise ValueError("All search calls failed")
+    print(f"Refined {len(web_search_result)} pages in {len(refine_futures)} prompts from {len(calls)} search calls")
+
+    # keep the evidence in page order regardless of completion order
+    evidence = [res for _, res in sorted(evidence, key=lambda x: x[0])]
     evidence_str = ""
     if len(evidence) == 0:
         evidence_str = "No helpful information found, you should try different angle to ask for help or try to answer the question by yourself."
@@ -98,26 +241,28 @@ def calculator(state: OverallState, config: RunnableConfig) -> OverallState:
     to_execute = state["tool_content"][-1]
     if isinstance(to_execute, list):
         to_execute = to_execute[0]
-    try:
-        res = eval(to_execute)
-    except:
-        res = safe_exec(to_execute)
-        if res['success']:
-            res = res['output']
-        else:
-            res = "Error: " + res['error']
+    configurable = Configuration.from_runnable_config(config)
+    executor = get_code_executor(configurable.code_workers, configurable.code_timeout, configurable.code_memory_mb)
+    res = executor.execute(to_execute)
+    if res['success']:
+        res = res['output']
+    else:
+        res = "Error: " + res['error']
     print_color("calculator result: ", bcolors.OKGREEN)
     print(res)
-    state["reasoning_str"] += f"Code execution tool provided the following result: {res}"
+    state["reasoning_str"] += f"\n\n<evidence> Code execution tool provided the following result: {res} </evidence>\n\n"
     return {
-        "tool_result": [res]
+        "tool_result": [res],
+        "reasoning_str": state["reasoning_str"]
     }
 
 def search_node(state: OverallState, config: RunnableConfig) -> OverallState:
     configurable = Configuration.from_runnable_config(config)
     queries = state["tool_content"][-1]
     searched_query = chain(*state["tool_content"][:-1])
-    search_intention = state["help_content"][-1]
+    help_content = state["help_content"][-1]
+    search_intention, _ = split_tool_call(help_content)
+    search_intention = search_intention or "; ".join(queries)
     if len(state["tool_content"]) == 1:
         first_search = True
     else:
@@ -130,9 +275,9 @@ def search_node(state: OverallState, config: RunnableConfig) -> OverallState:
 
     if len(query_to_search) == 0:
         print_color("query already searched", bcolors.OKBLUE)
-        result_index = state["help_content"].index(search_intention)
+        result_index = state["help_content"].index(help_content)
         query_result = state["tool_result"][result_index]
-        state["reasoning_str"] += f"You have already searched the internet for the intention: {search_intention}. Search tool provided the following result: {query_result}"
+        state["reasoning_str"] += f"\n\n<evidence> You have already searched the internet for the intention: {search_intention}. Search tool provided the following result: {query_result} </evidence>\n\n"
         return {
             "reasoning_str": state["reasoning_str"]
         }
@@ -145,6 +290,28 @@ def search_node(state: OverallState, config: RunnableConfig) -> OverallState:
     }
 
 
+def is_tool_response(response_content: str) -> bool:
+    try:
+        response = json.loads(response_content)
+        return "tool" in response and "content" in response
+    except (ValueError, TypeError):
+        return False
+
+def parse_reflection_response(response: str) -> tuple[str, str]:
+    """(answer correctness, suggested answer) of a critical thinking response"""
+    analysis = extract_between(response, "<analysis>", "</analysis>")
+    analysis = analysis.split("\n")
+    answer_correctness = analysis[0].split(": ")[1].strip()
+    suggested_answer = analysis[1].split(": ")[1].strip()
+    return answer_correctness, suggested_answer
+
+def is_reflection_response(response: str) -> bool:
+    try:
+        parse_reflection_response(response)
+        return True
+    except (AttributeError, IndexError):
+        return False
+
 def router_node(state: OverallState, config: RunnableConfig) -> OverallState:
     configurable = Configuration.from_runnable_config(config)
 
@@ -156,24 +323,44 @@ def router_node(state: OverallState, config: RunnableConfig) -> OverallState:
 
     elif state["status"][-1] == "help":
         help_content = state["help_content"][-1]
-        tool_prompt = get_tool_prompt(help_content, state["tool_selection"], state["tool_content"], state["tool_result"])
-
-        tool_prompt = qwen_no_think_template.format(prompt=tool_prompt)
-        auxiliary_agent = get_auxiliary_agent(configurable)
-        auxiliary_agent_name = configurable.auxiliary_model
-
-        response_content = stream_completion(
-            auxiliary_agent, 
-            auxiliary_agent_name, 
-            tool_prompt, 
-            note="tool response: ",
-            stream=False,
-            schema=tool_result
-        )
-
-        response = json.loads(response_content)
-        print_color("tool response: ", bcolors.HEADER)
-        print(response)
+        response = None
+        if configurable.tool_dispatch == "local":
+            intention, response = split_tool_call(help_content)
+            if response is not None:
+                print_color("tool call: ", bcolors.HEADER)
+            elif has_tool_call(help_content) and configurable.auxiliary_model:
+                # a malformed or truncated tool call is left to the auxiliary model
+                print_color("tool call could not be parsed", bcolors.WARNING)
+            else:
+                response = classify_tool_request(intention) if intention else None
+                if response is None and not configurable.auxiliary_model:
+                    # nothing usable was written, so search for the task itself
+                    response = {"tool": "search", "content": [intention or state["messages"][0].content]}
+                if response is not None:
+                    print_color("tool classified: ", bcolors.HEADER)
+            if response is not None:
+                print(response)
+
+        if response is None:
+            tool_prompt = get_tool_prompt(help_content, state["tool_selection"], state["tool_content"], state["tool_result"])
+
+            tool_prompt = qwen_no_think_template.format(prompt=tool_prompt)
+            auxiliary_agent = get_auxiliary_agent(configurable)
+            auxiliary_agent_name = configurable.auxiliary_model
+
+            response_content = stream_completion(
+                auxiliary_agent, 
+                auxiliary_agent_name, 
+                tool_prompt, 
+                note="tool response: ",
+                stream=False,
+                schema=tool_result,
+                validate=is_tool_response
+            )
+
+            response = json.loads(response_content)
+            print_color("tool response: ", bcolors.HEADER)
+            print(response)
 
         state["tool_selection"].append(response["tool"])
         state["tool_content"].append(response["content"])
@@ -229,12 +416,10 @@ def reflection_node(state: OverallState, config: RunnableConfig) -> OverallState
             reasoning_agent, 
             reasoning_agent_name, 
             prompt, 
-            note="critical thinking response: "
+            note="critical thinking response: ",
+            validate=is_reflection_response
         )
-        analysis = extract_between(response, "<analysis>", "</analysis>")
-        analysis = analysis.split("\n")
-        answer_correctness = analysis[0].split(": ")[1].strip()
-        suggested_answer = analysis[1].split(": ")[1].strip()
+        answer_correctness, suggested_answer = parse_reflection_response(response)
     else:
         answer_correctness = "correct"
         suggested_answer = "n/a"
@@ -277,14 +462,23 @@ def reasoning_node(state: OverallState, config: RunnableConfig) -> OverallState:
     if len(state["status"]) > 1 and state["status"][-1] == "correct_answer":
         return {}
 
+    # reasoning_str is only ever appended to (apart from compaction near the token budget),
+    # so each step's prompt extends the previous one and the server can reuse its KV cache
     if not state["reasoning_str"] or state["status"][-1] == "incorrect_answer":
-        prompt = get_qa_prompt_reasoning(state["messages"][0].content, state["experience"], state["previous_critical_thinking"])
+        prompt = get_qa_prompt_reasoning(state["messages"][0].content, state["experience"], state["previous_critical_thinking"], configurable.tool_dispatch == "local")
         prompt = qwen_think_template.format(prompt=prompt)
         state["reasoning_str"] = prompt
-    elif len(state["status"]) > 15 or len(state["reasoning_str"]) > 120000:
-        prompt = state["reasoning_str"] +"\n\n You have reached the maximum number of reasoning steps. Please provide your final answer.\n\n"
     else:
-        prompt = state["reasoning_str"]
+        # compact older evidence and steps once the prompt nears the token budget
+        state["reasoning_str"], num_tokens = compact_reasoning_str(
+            state["reasoning_str"],
+            int(configurable.reasoning_token_budget * configurable.compaction_threshold),
+            configurable.reasoning_tokenizer
+        )
+        if len(state["status"]) > 15 or num_tokens > configurable.reasoning_token_budget:
+            prompt = state["reasoning_str"] +"\n\n You have reached the maximum number of reasoning steps. Please provide your final answer.\n\n"
+        else:
+            prompt = state["reasoning_str"]
         
     agent, agent_name = get_reasoning_agent(configurable)
 
@@ -298,7 +492,8 @@ def reasoning_node(state: OverallState, config: RunnableConfig) -> OverallState:
         prompt,
         max_tokens=30000,
         stop=stop, 
-        note="reasoning response: ")
+        note="reasoning response: ",
+        validate=lambda response: "<answer>" in response or "<help>" in response)
 
     if "<answer>" in response_content and not response_content.endswith("</answer>"):
         response_content += "</answer>"
@@ -329,7 +524,7 @@ def reasoning_node(state: OverallState, config: RunnableConfig) -> OverallState:
     else:
         raise ValueError("Invalid response")
 
-def get_graph(config: Configuration):  
+def get_graph(config: Configuration, checkpointer=None):  
 
     workflow = StateGraph(OverallState, config_schema=config)
 
@@ -346,6 +541,6 @@ def get_graph(config: Configuration):
     workflow.add_edge("calculator", "reasoning")
     workflow.add_edge("reflection", "reasoning")
     workflow.add_edge("summarize_experience", END)
-    app = workflow.compile()
+    app = workflow.compile(checkpointer=checkpointer)
     return app
 
@@ -1,7 +1,7 @@
 qwen_think_template = '<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n<think>\n'
 qwen_no_think_template = '<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n'
 
-def get_qa_prompt_reasoning(query: str, experience: list = [], previous_critical_thinking: list = []) -> str:
+def get_qa_prompt_reasoning(query: str, experience: list = [], previous_critical_thinking: list = [], structured_tool_calls: bool = False) -> str:
     reflection_analysis = ""
     for i, c in enumerate(previous_critical_thinking):
         reflection_analysis += f"Reflection {i+1}: {c}\n"
@@ -101,18 +101,37 @@ Key points to consider from your reflection:
 - Use the improved methodology and insights gained from the reflection
 
 Now please redo the current task with this enhanced understanding.
+"""
+
+    tool_description = "\n".join([f"- {tool}: {tool_dict[tool]['description']}" for tool in tool_dict])
+    tool_call_str = f"""
+Tool calls:
+End every <help> block with the tool call that serves it, as a JSON object inside <tool_call> tags:
+<help>
+Describe what kind of help you need
+<tool_call>{{"tool": "tool_name", "content": ["tool_specific_content1", "tool_specific_content2"]}}</tool_call>
+</help>
+
+Available tools:
+{tool_description}
+
+- For search, write short Google-style queries of 2 to 5 keywords (e.g. "Tokyo population 2023"), one per search intention, in the language of the request.
+- For calculator and code_execution, write one self-contained Python snippet that prints the result, using only the standard library and numpy/sympy.
 """
 
     task_str = f"""Current task: {query}
 """
-    if reflection_analysis != "" and experience != []:
-        return base_str + experience_str + reflection_str + task_str
-    elif reflection_analysis != "":
-        return base_str + reflection_str + task_str
-    elif experience != []:
-        return base_str + experience_str + task_str
-    else:
-        return base_str + task_str
+    # Ordered from most to least stable (instructions, experience, task, reflection) so that the
+    # server's prefix cache is reused across questions and when a task is redone after reflection.
+    prompt = base_str
+    if structured_tool_calls:
+        prompt += tool_call_str
+    if experience != []:
+        prompt += experience_str
+    prompt += task_str
+    if reflection_analysis != "":
+        prompt += reflection_str
+    return prompt
 
 
 tool_dict = {
@@ -204,9 +223,9 @@ Guidelines:
 - Do not output any content outside the <evidence> tags or the exact phrase 'No helpful information found'.
 
 Context:
+- Search intention: {oringinal_task}
 - Previous reasoning: {prev_reasoning}
 - Search query: {help_content}
-- Search intention: {oringinal_task}
 - Web page content: {document}
 
 Your output must be:
@@ -214,6 +233,40 @@ Your output must be:
 - Or No helpful information found (if nothing meets the above criteria)
 """
 
+def get_webpages_to_reasonchain_instruction(prev_reasoning: str, help_content: str, oringinal_task: str, documents: list[str]) -> str:
+    pages = "\n\n".join(f"Web page [{i+1}]:\n{document}" for i, document in enumerate(documents))
+    return f"""Your task is to extract factual evidence from several web pages to support a larger reasoning process.
+
+Instructions:
+1. Carefully read the content of every provided web page.
+2. Extract only objective, verifiable, and relevant facts, data, or conclusions that directly address the current search query or search intention.
+3. Ignore any subjective opinions, irrelevant content, or information not directly useful for advancing the reasoning chain.
+4. For each piece of helpful information, briefly explain its direct relevance to the search query or original task.
+5. If you find no helpful information in any page, reply exactly: No helpful information found
+6. For every page with helpful information, output one block in the following format, where N is the number of the page:
+<evidence page="N">
+(Concise, factual information extracted from page N, with clear indication of its relevance)
+</evidence>
+
+Guidelines:
+- Focus on facts, statistics, primary data, names, dates, or directly cited details.
+- Do not paraphrase or interpret—extract and synthesize only factual, relevant content.
+- Include information only if it fills a gap or advances the prior reasoning. Note any contradiction with previous reasoning if found.
+- Never merge information from different pages into one block, and skip pages without helpful information.
+- Do not output any content outside the <evidence page="N"> tags or the exact phrase 'No helpful information found'.
+
+Context:
+- Search intention: {oringinal_task}
+- Previous reasoning: {prev_reasoning}
+- Search query: {help_content}
+- Web pages:
+{pages}
+
+Your output must be:
+- Either one <evidence page="N">...</evidence> block per helpful page (if helpful factual content found, directly relevant and advancing the reasoning)
+- Or No helpful information found (if nothing meets the above criteria)
+"""
+
 
 def get_summarize_experience_prompt(task_description: str, existing_experience: list = []) -> str:
     if existing_experience != []:
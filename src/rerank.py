@@ -0,0 +1,106 @@
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+from agent import get_client
+from config import Configuration
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "how", "in", "is", "it",
+    "of", "on", "or", "that", "the", "this", "to", "was", "were", "what", "when", "where", "which", "who",
+    "why", "will", "with",
+}
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+def split_passages(text: str, passage_chars: int = 1000) -> list[str]:
+    """Split page text into passages of about `passage_chars` characters, breaking at sentence ends."""
+    passages = []
+    current = ""
+    for sentence in re.split(r"(?<=[.!?\n])\s+", text):
+        if current and len(current) + len(sentence) + 1 > passage_chars:
+            passages.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+        # a sentence longer than a passage is cut where it is
+        while len(current) > passage_chars:
+            passages.append(current[:passage_chars])
+            current = current[passage_chars:]
+    if current.strip():
+        passages.append(current)
+    return passages
+
+def bm25_scores(passages: list[list[str]], query: list[str], k1: float = 1.5, b: float = 0.75) -> np.ndarray:
+    """BM25 score of every tokenized passage against the tokenized query, with IDF taken over the passages."""
+    if not passages:
+        return np.zeros(0)
+    query_terms = set(query)
+    avg_len = sum(len(passage) for passage in passages) / len(passages) or 1.0
+    doc_freq = Counter(term for passage in passages for term in query_terms.intersection(passage))
+    scores = np.zeros(len(passages))
+    for i, passage in enumerate(passages):
+        counts = Counter(token for token in passage if token in query_terms)
+        for term, tf in counts.items():
+            idf = math.log(1 + (len(passages) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            scores[i] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(passage) / avg_len))
+    return scores
+
+def embed_texts(texts: list[str], config: Configuration) -> np.ndarray:
+    """Unit-normalized embeddings of the texts from config.rerank_embedding_model."""
+    client = get_client(config, config.rerank_embedding_base_url, config.rerank_embedding_api_key or "not-needed")
+    response = client.embeddings.create(input=texts, model=config.rerank_embedding_model)
+    vectors = np.array([item.embedding for item in sorted(response.data, key=lambda item: item.index)], dtype=np.float32)
+    return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+
+def embedding_scores(passages: list[str], query: str, config: Configuration) -> np.ndarray:
+    """Cosine similarity of every passage to the query, embedded with config.rerank_embedding_model."""
+    vectors = embed_texts([query] + passages, config)
+    return vectors[1:] @ vectors[0]
+
+def rerank_results(results: list[dict], query: str, config: Configuration) -> list[dict]:
+    """
+    Keep the most relevant passages of each search result and order the results by relevance.
+
+    Each page is split into passages, scored with BM25 against `query` (IDF over the passages of
+    all given pages) and, with config.rerank_embedding_model set, the cosine similarity of their
+    embeddings. A page keeps its config.rerank_top_passages best passages, in page order, and is
+    scored by their sum; pages no passage of which matches the query are dropped.
+
+    Args:
+        results: Formatted search results with a 'content' key
+        query: The search intention and queries the passages should answer
+
+    Returns:
+        list: Copies of the results with reduced content, most relevant first
+    """
+    pages = [split_passages(result["content"], config.rerank_passage_chars) for result in results]
+    flat = [passage for passage_list in pages for passage in passage_list]
+    if not flat:
+        return []
+
+    scores = bm25_scores([tokenize(passage) for passage in flat], tokenize(query))
+    if config.rerank_embedding_model:
+        try:
+            relevant = scores > 0
+            if scores.max() > 0:
+                scores = scores / scores.max()
+            # BM25 is a cheap first stage: only passages sharing a term with the query are embedded
+            scores[relevant] += embedding_scores([flat[i] for i in np.flatnonzero(relevant)], query, config)
+        except Exception as e:
+            print(f"Embedding rerank failed, using BM25 only: {e}")
+
+    reranked = []
+    start = 0
+    for result, passage_list in zip(results, pages):
+        page_scores = scores[start:start + len(passage_list)]
+        start += len(passage_list)
+        top = sorted(np.argsort(-page_scores, kind="stable")[:config.rerank_top_passages])
+        top = [i for i in top if page_scores[i] > 0]
+        if not top:
+            continue
+        reranked.append(({**result, "content": "\n...\n".join(passage_list[i] for i in top)}, float(page_scores[top].sum())))
+    reranked.sort(key=lambda x: x[1], reverse=True)
+    return [result for result, _ in reranked]
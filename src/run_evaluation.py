@@ -1,44 +1,56 @@
 from graph import get_graph
 from langchain_core.messages import HumanMessage
 from config import Configuration
+from agent import _get_reasoning_endpoint
 from datetime import datetime
 from evaluation import calculate_metrics_by_level
 from collections import defaultdict
+from cache import CompletionCache, set_completion_cache, get_completion_cache, EvidenceCache, set_evidence_cache, get_evidence_cache
+from utils import get_prefix_cache_stats, prefix_cache_hit_rate
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
 import json
 
 def load_json(file_path):
     with open(file_path, "r") as f:
         return json.load(f)
 
-config = Configuration.from_runnable_config()
-graph = get_graph(config)
-
-print(config, "\n", "="*100, "\n")
-
-task = config.eval_task
-if task == "GAIA":
-    data = load_json("data/GAIA/dev.json")
-elif task == "webwalker":
-    data = load_json("data/webwalker/test.json")
-elif task == "BrowseComp":
-    data = load_json("data/BrowseComp/subset.json")
-else:
-    raise ValueError(f"Invalid task: {task}")
+def load_jsonl(file_path):
+    with open(file_path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
 
-save_file = f"data/{task}/{config.version}.{datetime.now().strftime('%Y-%m-%d_%H:%M')}.jsonl"
-with open(save_file, "w") as f:
-    json.dump(config.__dict__, f, ensure_ascii=False)
-    f.write("\n")
+def get_question_id(line):
+    """Stable ID of a dataset question, falling back to a hash of the question text."""
+    if line.get("task_id"):
+        return str(line["task_id"])
+    if line.get("id"):
+        return str(line["id"])
+    return hashlib.md5(line["Question"].encode("utf-8")).hexdigest()
 
-experience_list = []
-for i,line in enumerate(data):
+def run_question(line, experience):
+    """Run the graph on a single question with retries, filling the result fields of `line` in place."""
     question = line["Question"]
     answer = line["answer"]
 
-    success = False
+    run_config = {"recursion_limit": 50}
+    if checkpointer is not None:
+        # threads are scoped to the run file, so only resuming that run reuses its checkpoints
+        run_config["configurable"] = {"thread_id": f"{os.path.abspath(save_file)}:{get_question_id(line)}"}
+
     for attempt in range(config.max_retries):
         try:
-            result = graph.invoke({"messages": [{"role": "user", "content": question}], "evidence": [], "true_answer": answer, "reasoning_str": "", "experience": experience_list[-1:]},{"recursion_limit": 50})
+            inputs = {"messages": [{"role": "user", "content": question}], "evidence": [], "true_answer": answer, "reasoning_str": "", "experience": experience}
+            snapshot = graph.get_state(run_config) if checkpointer is not None else None
+            if snapshot is not None and snapshot.values and not snapshot.next:
+                # finished in an earlier run but never written to the result file
+                result = snapshot.values
+            else:
+                if snapshot is not None and snapshot.next:
+                    print(f"Resuming question {get_question_id(line)} from checkpoint before {snapshot.next}")
+                    inputs = None
+                result = graph.invoke(inputs, run_config)
             line["predicted_answer"] = result["messages"][-1].content
             line["tool_selection"] = result["tool_selection"]
             line["tool_content"] = result["tool_content"]
@@ -51,11 +63,8 @@ for i,line in enumerate(data):
             line["status"] = "success"
             line["attempts"] = attempt + 1
             line["experience"] = result["experience"]
-            
+
             line["llm_equivalence"] = result["llm_equivalence"]
-            if result["experience"] != "":
-                experience_list.append([question, result["experience"]])
-            success = True
             break
         except Exception as e:
             print(f"Attempt {attempt + 1} failed: {str(e)}")
@@ -71,13 +80,115 @@ for i,line in enumerate(data):
         line["Level"] = line["difficulty_level"]
     elif config.eval_task in ["BrowseComp"]:
         line["Level"] = line["problem_topic"]
+    return line
+
+def save_line(line):
     with open(save_file, "a") as f:
         json.dump(line, f, ensure_ascii=False)
         f.write("\n")
+    if config.measure_prefix_cache:
+        print("prefix cache: ", prefix_cache_hit_rate(prefix_cache_start, get_prefix_cache_stats(prefix_cache_url)))
     print("="*100)
 
+config = Configuration.from_runnable_config()
+checkpointer = None
+if config.checkpoint_db:
+    from langgraph.checkpoint.sqlite import SqliteSaver
+    checkpointer = SqliteSaver(sqlite3.connect(config.checkpoint_db, check_same_thread=False))
+graph = get_graph(config, checkpointer=checkpointer)
+if config.completion_cache:
+    set_completion_cache(CompletionCache(config.completion_cache, config.completion_cache_size_mb))
+if config.evidence_cache:
+    set_evidence_cache(EvidenceCache(config.evidence_cache, config.evidence_cache_max_entries, config.evidence_cache_similarity))
+
+print(config, "\n", "="*100, "\n")
+
+task = config.eval_task
+if task == "GAIA":
+    data = load_json("data/GAIA/dev.json")
+elif task == "webwalker":
+    data = load_json("data/webwalker/test.json")
+elif task == "BrowseComp":
+    data = load_json("data/BrowseComp/subset.json")
+else:
+    raise ValueError(f"Invalid task: {task}")
+
+experience_list = []
+if config.resume_file:
+    save_file = config.resume_file
+    # the first line of a run file is the configuration it was started with
+    saved_lines = load_jsonl(save_file)
+    finished_lines = {get_question_id(line): line for line in saved_lines[1:] if line.get("status") == "success"}
+    # drop failed lines, the questions are run again and saved anew; the file is replaced
+    # atomically so an interrupted rewrite cannot lose finished results
+    with open(save_file + ".tmp", "w") as f:
+        for line in saved_lines[:1] + list(finished_lines.values()):
+            json.dump(line, f, ensure_ascii=False)
+            f.write("\n")
+    os.replace(save_file + ".tmp", save_file)
+    for line in finished_lines.values():
+        if line.get("experience"):
+            experience_list.append([line["Question"], line["experience"]])
+    data = [finished_lines.get(get_question_id(line), line) for line in data]
+    print(f"Resuming {save_file}: {len(finished_lines)} questions already finished")
+else:
+    finished_lines = {}
+    save_file = f"data/{task}/{config.version}.{datetime.now().strftime('%Y-%m-%d_%H:%M')}.jsonl"
+    with open(save_file, "w") as f:
+        json.dump(config.__dict__, f, ensure_ascii=False)
+        f.write("\n")
+
+if config.measure_prefix_cache:
+    # the reasoning steps run on the advanced reasoning model when one is configured
+    prefix_cache_url = _get_reasoning_endpoint(config, True)[0]
+    prefix_cache_start = get_prefix_cache_stats(prefix_cache_url)
+
+todo = [i for i, line in enumerate(data) if get_question_id(line) not in finished_lines]
+if config.concurrency <= 1:
+    for i in todo:
+        line = run_question(data[i], experience_list[-1:])
+        if line.get("experience"):
+            experience_list.append([line["Question"], line["experience"]])
+        save_line(line)
+else:
+    # Keep at most `concurrency` questions in flight and submit the next one only when
+    # a slot frees up, so later questions still see the most recent experience.
+    pending = {}
+    finished = {}
+    next_to_submit = 0
+    next_to_save = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.concurrency) as executor:
+        while next_to_submit < len(todo) or pending:
+            while next_to_submit < len(todo) and len(pending) < config.concurrency:
+                future = executor.submit(run_question, data[todo[next_to_submit]], experience_list[-1:])
+                pending[future] = next_to_submit
+                next_to_submit += 1
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                line = future.result()
+                if line.get("experience"):
+                    experience_list.append([line["Question"], line["experience"]])
+                if config.ordered_output:
+                    finished[i] = line
+                else:
+                    save_line(line)
+
+            while next_to_save in finished:
+                save_line(finished.pop(next_to_save))
+                next_to_save += 1
+
 level_metrics = calculate_metrics_by_level(data)
 level_metrics["save_file"] = save_file
+if config.measure_prefix_cache:
+    level_metrics["prefix_cache"] = prefix_cache_hit_rate(prefix_cache_start, get_prefix_cache_stats(prefix_cache_url))
+if get_completion_cache() is not None:
+    print("completion cache: ", get_completion_cache().stats())
+    level_metrics["completion_cache"] = get_completion_cache().stats()
+if get_evidence_cache() is not None:
+    print("evidence cache: ", get_evidence_cache().stats())
+    level_metrics["evidence_cache"] = get_evidence_cache().stats()
 with open(f"data/{task}.metrics.jsonl", "a") as f:
     f.write(json.dumps(level_metrics, ensure_ascii=False))
     f.write("\n")
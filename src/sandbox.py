@@ -0,0 +1,161 @@
+import contextlib
+import io
+import json
+import os
+import queue
+import select
+import signal
+import subprocess
+import sys
+import threading
+import traceback
+from typing import Optional
+
+PRELOADED_MODULES = ["math", "cmath", "statistics", "fractions", "decimal", "itertools", "collections", "datetime", "re", "numpy", "sympy"]
+
+class CodeExecutor:
+    """
+    A pre-warmed pool of sandboxed Python worker processes for the calculator/code tool.
+
+    Each worker runs this file as a script with memory and CPU limits, keeps numpy/sympy
+    imported, and captures the stdout of every call separately, so calls from concurrent
+    questions never share output. A call exceeding the time limit kills its worker, which
+    is replaced by a fresh one.
+    """
+
+    def __init__(self, num_workers: int = 4, timeout: float = 30, memory_mb: int = 2048, cpu_seconds: Optional[float] = None):
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds if cpu_seconds is not None else timeout
+        self.idle = queue.Queue()
+        for _ in range(num_workers):
+            self.idle.put(self._spawn())
+
+    def _spawn(self) -> subprocess.Popen:
+        env = dict(os.environ, OPENBLAS_NUM_THREADS="1", OMP_NUM_THREADS="1", MKL_NUM_THREADS="1")
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(self.memory_mb), str(self.cpu_seconds)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            env=env,
+        )
+
+    def execute(self, code: str, timeout: Optional[float] = None) -> dict:
+        """
+        Evaluate `code` as an expression, or execute it as statements if that fails.
+
+        Returns:
+            dict: {'success': bool, 'output': str, 'error': str} as returned by safe_exec
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        worker = self.idle.get()
+        try:
+            worker.stdin.write(json.dumps({"code": code}) + "\n")
+            worker.stdin.flush()
+            ready, _, _ = select.select([worker.stdout], [], [], timeout)
+            if not ready:
+                worker.kill()
+                worker.wait()
+                worker = self._spawn()
+                return {'success': False, 'output': '', 'error': f"Execution timed out after {timeout} seconds"}
+            line = worker.stdout.readline()
+            if not line:
+                # end of output: the worker died, label it by the signal that ended it
+                worker.kill()
+                returncode = worker.wait()
+                worker = self._spawn()
+                if returncode == -signal.SIGXCPU:
+                    return {'success': False, 'output': '', 'error': "Execution exceeded its CPU time limit"}
+                if returncode == -signal.SIGKILL:
+                    return {'success': False, 'output': '', 'error': "Execution was killed, possibly for running out of memory"}
+                return {'success': False, 'output': '', 'error': "Execution exceeded its memory limit or crashed"}
+            return json.loads(line)
+        except (BrokenPipeError, OSError, ValueError) as e:
+            worker.kill()
+            worker.wait()
+            worker = self._spawn()
+            return {'success': False, 'output': '', 'error': f"Execution failed: {e}"}
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        while not self.idle.empty():
+            worker = self.idle.get()
+            worker.kill()
+            worker.wait()
+
+
+_executor: Optional[CodeExecutor] = None
+_executor_lock = threading.Lock()
+
+def get_code_executor(num_workers: int = 4, timeout: float = 30, memory_mb: int = 2048) -> CodeExecutor:
+    """Return the process-wide CodeExecutor, starting its workers on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = CodeExecutor(num_workers=num_workers, timeout=timeout, memory_mb=memory_mb)
+        return _executor
+
+
+def _run(code: str, preloaded: dict) -> dict:
+    globals_dict = {"__builtins__": __builtins__, **preloaded}
+    output = io.StringIO()
+    # mirror the calculator: code that compiles as an expression is evaluated, the rest executed,
+    # deciding before anything runs so the code runs once
+    try:
+        compiled, is_expression = compile(code, "<string>", "eval"), True
+    except SyntaxError:
+        compiled, is_expression = None, False
+    if compiled is None:
+        try:
+            compiled = compile(code, "<string>", "exec")
+        except SyntaxError:
+            return {'success': False, 'output': '', 'error': traceback.format_exc()}
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            result = eval(compiled, globals_dict)
+            if is_expression and result is not None:
+                return {'success': True, 'output': str(result), 'error': ''}
+            return {'success': True, 'output': output.getvalue().strip(), 'error': ''}
+        except BaseException:
+            return {'success': False, 'output': output.getvalue().strip(), 'error': traceback.format_exc()}
+
+def _worker(memory_mb: int, cpu_seconds: float):
+    import resource
+    import importlib
+
+    if memory_mb > 0:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024 * 1024, memory_mb * 1024 * 1024))
+
+    # answer on a private copy of stdout, so code writing to fd 1 cannot corrupt the protocol
+    protocol = os.fdopen(os.dup(1), "w")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    preloaded = {}
+    for name in PRELOADED_MODULES:
+        try:
+            preloaded[name] = importlib.import_module(name)
+        except ImportError:
+            continue
+    if "numpy" in preloaded:
+        preloaded["np"] = preloaded["numpy"]
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        if cpu_seconds > 0:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = usage.ru_utime + usage.ru_stime
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            resource.setrlimit(resource.RLIMIT_CPU, (int(used + cpu_seconds) + 1, hard))
+        try:
+            response = _run(request["code"], preloaded)
+        except MemoryError:
+            response = {'success': False, 'output': '', 'error': "MemoryError: execution exceeded the memory limit"}
+        protocol.write(json.dumps(response) + "\n")
+        protocol.flush()
+
+if __name__ == "__main__":
+    _worker(int(sys.argv[1]), float(sys.argv[2]))
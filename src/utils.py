@@ -10,8 +10,12 @@ from pydantic import BaseModel
 import requests
 from nltk.tokenize import sent_tokenize
 import nltk
-import concurrent.futures
+import threading
 import time
+import tiktoken
+from typing import Callable, Optional
+from cache import get_completion_cache
+from dedup import canonicalize_url, PageDeduplicator
 
 
 def safe_exec(code_str, globals_dict=None, locals_dict=None, timeout=None):
@@ -35,96 +39,130 @@ def safe_exec(code_str, globals_dict=None, locals_dict=None, timeout=None):
     finally:
         sys.stdout = old_stdout
 
-def clean_webpage_content(content: str) -> str:
+# URLs (http/https/ftp/www patterns) and email addresses, removed from page content
+URL_PATTERN = r'https?://[^\s<>"{}|\\^`\[\]]+|ftp://[^\s<>"{}|\\^`\[\]]+|www\.[^\s<>"{}|\\^`\[\]]+'
+EMAIL_PATTERN = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+url_regex = re.compile(URL_PATTERN)
+email_regex = re.compile(EMAIL_PATTERN)
+# Consecutive placeholder characters (dots, dashes, underscores, asterisks, equals) collapse to one
+placeholder_regex = re.compile(r'\.\.+|--+|__+|\*\*+|==+')
+newlines_regex = re.compile(r'\n{2,}')
+spaces_regex = re.compile(r'\s{2,}')
+whitespace_regex = re.compile(r'\s')
+# Start of a whitespace run, where a page can be cut into independently cleaned chunks
+chunk_boundary_regex = re.compile(r'(?<=\S)\s')
+
+def _remove_emails(content: str) -> str:
+    # An email never spans whitespace, so only run the (backtracking) email regex on the
+    # whitespace-delimited tokens that contain an '@'
+    pieces = []
+    last = 0
+    at = content.find('@')
+    while at != -1:
+        start = at
+        while start > last and not content[start - 1].isspace():
+            start -= 1
+        end = whitespace_regex.search(content, at)
+        end = end.start() if end is not None else len(content)
+        pieces.append(content[last:start])
+        pieces.append(email_regex.sub('', content[start:end]))
+        last = end
+        at = content.find('@', end)
+    pieces.append(content[last:])
+    return ''.join(pieces)
+
+def _collapse_whitespace(content: str) -> str:
+    content = newlines_regex.sub('\n', content)
+    return spaces_regex.sub(' ', content)
+
+def _clean(content: str) -> str:
+    content = url_regex.sub('', content)
+    content = _remove_emails(content)
+    content = placeholder_regex.sub(lambda match: match.group()[0], content)
+    return _collapse_whitespace(content)
+
+def clean_webpage_content(content: str, max_content_length: Optional[int] = None) -> str:
     """
     Clean webpage content by removing URLs, normalizing placeholders, and filtering out overly long words.
     
     Args:
         content (str): Raw webpage content to clean
+        max_content_length (Optional[int]): Truncate the cleaned content to this length, only cleaning
+            as much of the page as needed
         
     Returns:
         str: Cleaned content
     """
     if not content:
         return ""
-    
-    # Remove URLs (http/https/ftp/www patterns)
-    url_pattern = r'https?://[^\s<>"{}|\\^`\[\]]+|ftp://[^\s<>"{}|\\^`\[\]]+|www\.[^\s<>"{}|\\^`\[\]]+'
-    content = re.sub(url_pattern, '', content)
-    
-    # Remove email addresses
-    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-    content = re.sub(email_pattern, '', content)
-    
-    # Replace consecutive placeholder characters with single ones
-    # Common placeholders: dots, dashes, underscores, asterisks, equals, newlines
-    placeholder_patterns = [
-        (r'\.{2,}', '.'),  # Multiple dots to single dot
-        (r'-{2,}', '-'),   # Multiple dashes to single dash
-        (r'_{2,}', '_'),   # Multiple underscores to single underscore
-        (r'\*{2,}', '*'),  # Multiple asterisks to single asterisk
-        (r'={2,}', '='),   # Multiple equals to single equal
-        (r'\n{2,}', '\n'), # Multiple newlines to single newline
-        (r'\s{2,}', ' '),  # Multiple spaces to single space
-    ]
-    
-    for pattern, replacement in placeholder_patterns:
-        content = re.sub(pattern, replacement, content)
-    
-    cleaned_content = content.strip()
-    
-    return cleaned_content
 
+    if max_content_length is None:
+        return _clean(content).strip()
+
+    # Clean the page chunk by chunk until there is enough text. Chunks are cut just before
+    # a whitespace run, so every URL, email and placeholder run lies inside one chunk; only
+    # whitespace runs meeting at a cut need collapsing again once the chunks are joined.
+    chunk_size = max(max_content_length, 512) * 2
+    pieces = []
+    length = 0
+    start = 0
+    while start < len(content):
+        cut = chunk_boundary_regex.search(content, start + chunk_size)
+        end = cut.start() if cut is not None else len(content)
+        pieces.append(_clean(content[start:end]))
+        length += len(pieces[-1])
+        start = end
+        if length > max_content_length:
+            cleaned = _collapse_whitespace(''.join(pieces)).lstrip()
+            if len(cleaned.rstrip()) > max_content_length:
+                return cleaned[:max_content_length]
+    return _collapse_whitespace(''.join(pieces)).strip()[:max_content_length]
+
+def format_search_result(result, content_key: str = 'content', max_content_length: int = 30000) -> dict:
+    return {
+        'title': result.get('title', 'No title'),
+        'url': result.get('url', ''),
+        'content': clean_webpage_content(result.get(content_key, ''), max_content_length),
+        'snippet': result.get('snippet', '')
+    }
 
-def process_and_merge_search_results(results, cache_results, task_cache_results, config, max_content_length: int = 30000):
+def select_new_results(results: list, seen_urls: set, deduplicator: Optional[PageDeduplicator] = None) -> list:
     """
-    Process and merge search results from two sources, deduplicate by URL,
-    rerank content using rerank service, and format as JSON.
-    
+    Drop formatted results whose canonical URL was seen already or, with a deduplicator, whose
+    content nearly duplicates a page kept before. Among copies within `results`, the one with
+    the richest (longest) content is kept; a copy of a page kept by an earlier call is dropped
+    whatever its length. The kept results stay in their original order.
+    """
+    richest = {}
+    for i, result in enumerate(results):
+        url = canonicalize_url(result['url'])
+        if url in seen_urls:
+            continue
+        if url not in richest or len(result['content']) > len(results[richest[url]]['content']):
+            richest[url] = i
+    seen_urls.update(richest)
+    kept = sorted(richest.values())
+    if deduplicator is not None:
+        by_richness = sorted(kept, key=lambda i: len(results[i]['content']), reverse=True)
+        kept = sorted(i for i in by_richness if not deduplicator.is_duplicate(results[i]['content']))
+    return [results[i] for i in kept]
+
+def merge_new_search_results(search_results, seen_urls: set, content_key: str = 'content', max_content_length: int = 30000, deduplicator: Optional[PageDeduplicator] = None) -> list:
+    """
+    Format the results of one search response whose URL has not been seen yet. Across
+    responses the first copy of a page merged is kept, see select_new_results.
+
     Args:
-        results: Search results with keys: title, url, context, snippet
-        cache_results: Cache search results with keys: title, url, content, snippet
-        
+        search_results: Search response with a 'results' list
+        seen_urls: Canonical URLs already merged, updated in place
+        content_key: Key holding the page text ('context' for web search, 'content' for cache search)
+        deduplicator: Also drop pages nearly duplicating the content of pages merged before
+
     Returns:
-        str: Formatted JSON string with merged and reranked results
+        list: Newly merged results
     """
-    # Combine and deduplicate by URL
-    combined_results = {}
-    if 'results' in cache_results:
-        for result in cache_results['results']:
-            url = result.get('url', '')
-            if url and url not in combined_results:
-                combined_results[url] = {
-                    'title': result.get('title', 'No title'),
-                    'url': url,
-                    'content': clean_webpage_content(result.get('content', ''))[:max_content_length],
-                    'snippet': result.get('snippet', '')
-                }
-    # Process regular search results
-    if 'results' in results:
-        for result in results['results']:
-            url = result.get('url', '')
-            if url and url not in combined_results:
-                combined_results[url] = {
-                    'title': result.get('title', 'No title'),
-                    'url': url,
-                    'content': clean_webpage_content(result.get('context', ''))[:max_content_length],  # Use context as content
-                    'snippet': result.get('snippet', '')
-                }
-    
-    # Process cache search results
-    if 'results' in task_cache_results:
-        for result in task_cache_results['results']:
-            url = result.get('url', '')
-            if url and url not in combined_results:
-                combined_results[url] = {
-                    'title': result.get('title', 'No title'),
-                    'url': url,
-                    'content': clean_webpage_content(result.get('content', ''))[:max_content_length],
-                    'snippet': result.get('snippet', '')
-                }
-    
-    return list(combined_results.values())
+    results = [format_search_result(result, content_key, max_content_length) for result in search_results.get('results', []) if result.get('url')]
+    return select_new_results(results, seen_urls, deduplicator)
 
 def truncate_reasoning_str(reasoning_str: str) -> str:
     reasoning_str = reasoning_str.split("<think>")[-1]
@@ -138,6 +176,109 @@ def truncate_reasoning_str(reasoning_str: str) -> str:
                 truncated_reasoning_str += '...\n\n'
     return truncated_reasoning_str.strip('\n')
 
+_tokenizers = {}
+
+def get_tokenizer(name: str = ""):
+    """Load a tokenizer once per process: a Hugging Face tokenizer when `name` is given, else tiktoken's cl100k_base."""
+    if name not in _tokenizers:
+        if name:
+            from transformers import AutoTokenizer
+            _tokenizers[name] = AutoTokenizer.from_pretrained(name)
+        else:
+            _tokenizers[name] = tiktoken.get_encoding("cl100k_base")
+    return _tokenizers[name]
+
+def count_tokens(text: str, tokenizer_name: str = "") -> int:
+    tokenizer = get_tokenizer(tokenizer_name)
+    if isinstance(tokenizer, tiktoken.Encoding):
+        return len(tokenizer.encode(text, disallowed_special=()))
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+def pack_pages(pages: list[str], token_budget: int, tokenizer_name: str = "") -> list[list[int]]:
+    """
+    Group pages, in order, into as few groups as fit token_budget page tokens each.
+    A page larger than the budget gets a group of its own.
+
+    Returns:
+        list: Groups of page indices
+    """
+    groups = []
+    group_tokens = 0
+    for i, page in enumerate(pages):
+        tokens = count_tokens(page, tokenizer_name)
+        if groups and group_tokens + tokens <= token_budget:
+            groups[-1].append(i)
+            group_tokens += tokens
+        else:
+            groups.append([i])
+            group_tokens = tokens
+    return groups
+
+def compact_reasoning_str(reasoning_str: str, token_budget: int, tokenizer_name: str = "", keep_last: int = 5, evidence_chars: int = 1000) -> tuple[str, int]:
+    """
+    Shrink the reasoning history below token_budget, keeping the task prompt, <help> steps
+    and the last keep_last steps intact, as truncate_reasoning_str does for refinement prompts.
+    Older <evidence> blocks are cut to evidence_chars first, then older reasoning steps are
+    replaced with "...", then older evidence is reduced to its opening.
+
+    Returns:
+        tuple[str, int]: The compacted reasoning string and its token count
+    """
+    total = count_tokens(reasoning_str, tokenizer_name)
+    if total <= token_budget or "<think>" not in reasoning_str:
+        return reasoning_str, total
+
+    prefix, body = reasoning_str.split("<think>", 1)
+    prefix += "<think>"
+    # evidence blocks contain blank lines themselves, so keep them whole
+    segments, separators = [], []
+    for part in re.split(r"(<evidence>.*?</evidence>)", body, flags=re.DOTALL):
+        if part.startswith("<evidence>"):
+            segments.append(part)
+            separators.append("")
+        else:
+            steps = part.split("\n\n")
+            segments.extend(steps)
+            separators.extend([""] + ["\n\n"] * (len(steps) - 1))
+    tokens = [count_tokens(seg, tokenizer_name) for seg in segments]
+    total = count_tokens(prefix, tokenizer_name) + sum(tokens)
+    protected = {0} | set(range(max(len(segments) - keep_last, 0), len(segments)))
+    protected |= {i for i, seg in enumerate(segments) if "<help>" in seg}
+
+    def shrink(i, new_seg):
+        nonlocal total
+        new_tokens = count_tokens(new_seg, tokenizer_name)
+        total += new_tokens - tokens[i]
+        segments[i], tokens[i] = new_seg, new_tokens
+
+    for i, seg in enumerate(segments):
+        if total <= token_budget:
+            break
+        if i not in protected and seg.startswith("<evidence>") and len(seg) > evidence_chars:
+            shrink(i, seg[:evidence_chars] + " ...(compacted) </evidence>")
+    for i, seg in enumerate(segments):
+        if total <= token_budget:
+            break
+        if i not in protected and not seg.startswith("<evidence>") and seg not in ("", "..."):
+            shrink(i, "...")
+    for i, seg in enumerate(segments):
+        if total <= token_budget:
+            break
+        if i not in protected and seg.startswith("<evidence>") and len(seg) > 200:
+            shrink(i, seg[:200] + " ...(compacted) </evidence>")
+
+    # collapse runs of removed steps into a single "..."
+    body = ""
+    previous = None
+    for separator, seg in zip(separators, segments):
+        if seg == "..." and previous == "...":
+            continue
+        if seg != "":
+            previous = seg
+        body += separator + seg
+    compacted_str = prefix + body
+    return compacted_str, count_tokens(compacted_str, tokenizer_name)
+
 def format_task_description(state: OverallState) -> str:
     description = f"""
 The original task is: {state["messages"][0].content}
@@ -163,6 +304,42 @@ def extract_between(text, start_marker, end_marker):
         return matches[0][::-1].strip()
     return None
 
+def get_prefix_cache_stats(base_url: str) -> dict:
+    """
+    Read the prefix cache counters from a vLLM server's Prometheus /metrics endpoint.
+
+    Args:
+        base_url (str): The OpenAI-compatible base URL of the server, e.g. http://localhost:12345/v1/
+
+    Returns:
+        dict: Cumulative prefix cache queries and hits in tokens (empty if unavailable)
+    """
+    metrics_url = re.sub(r"/v1/?$", "", base_url.rstrip("/")) + "/metrics"
+    try:
+        response = requests.get(metrics_url, timeout=10)
+        response.raise_for_status()
+    except Exception as e:
+        print(f"Failed to read prefix cache metrics from {metrics_url}: {e}")
+        return {}
+    stats = {"queries": 0.0, "hits": 0.0}
+    for line in response.text.splitlines():
+        if line.startswith("#"):
+            continue
+        name = line.split("{")[0].split(" ")[0]
+        if name.endswith("prefix_cache_queries_total"):
+            stats["queries"] += float(line.rsplit(" ", 1)[-1])
+        elif name.endswith("prefix_cache_hits_total"):
+            stats["hits"] += float(line.rsplit(" ", 1)[-1])
+    return stats
+
+def prefix_cache_hit_rate(start: dict, end: dict) -> dict:
+    """Prefix cache hit rate between two get_prefix_cache_stats snapshots."""
+    if not start or not end:
+        return {}
+    queries = end["queries"] - start["queries"]
+    hits = end["hits"] - start["hits"]
+    return {"queries": queries, "hits": hits, "hit_rate": round(hits / queries, 4) if queries else 0.0}
+
 class bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -178,8 +355,34 @@ def print_color(text, color):
 
     print(f"{color}{text}{bcolors.ENDC}")
 
-def stream_completion(agent, model_name, prompt, stop=None, note=None, stream=True, schema: BaseModel = None, max_tokens: int = 10000, top_p: float = 0.8, temperature: float = 0.7, repetition_penalty: float = 1.05, min_p: float = 0.05, top_k: int = 20):
-    
+def stream_completion(agent, model_name, prompt, stop=None, note=None, stream=True, schema: BaseModel = None, max_tokens: int = 10000, top_p: float = 0.8, temperature: float = 0.7, repetition_penalty: float = 1.05, min_p: float = 0.05, top_k: int = 20, cancel: Optional[threading.Event] = None, validate: Optional[Callable[[str], bool]] = None):
+    """
+    Complete `prompt`, printing the response as it streams in when `stream` is set.
+
+    With `cancel`, the response is always streamed from the server, and setting the event
+    closes the stream so the server stops generating; a cancelled call returns the partial
+    response, which is not cached.
+    With `validate`, only responses it accepts are cached or served from the cache, so a
+    retry after a response that failed parsing asks the model again.
+    """
+    if cancel is not None and cancel.is_set():
+        return ""
+
+    cache = get_completion_cache()
+    if cache is not None:
+        cache_key = cache.make_key(
+            model=model_name, prompt=prompt, stop=stop, max_tokens=max_tokens, top_p=top_p, temperature=temperature,
+            repetition_penalty=repetition_penalty, min_p=min_p, top_k=top_k,
+            schema=schema.model_json_schema() if schema else None
+        )
+        cached = cache.get(cache_key)
+        if cached is not None and (validate is None or validate(cached)):
+            if note:
+                print_color(note + "(cached)", bcolors.OKGREEN)
+            if stream:
+                print(cached, flush=True)
+            return cached
+
     num_try = 0
     while num_try < 5:
         try:
@@ -189,7 +392,7 @@ def stream_completion(agent, model_name, prompt, stop=None, note=None, stream=Tr
                 max_tokens=max_tokens,
                 top_p=top_p,
                 temperature=temperature,
-                stream=stream,
+                stream=stream or cancel is not None,
                 stop=stop,
                 extra_body={
                     "min_p": min_p,
@@ -207,52 +410,22 @@ def stream_completion(agent, model_name, prompt, stop=None, note=None, stream=Tr
 
     if note:
         print_color(note, bcolors.OKGREEN)
-    if stream:
+    if stream or cancel is not None:
         response_content = ""   
         for chunk in response:
             response_content += chunk.choices[0].text
-            print(chunk.choices[0].text, end="", flush=True)
-        return response_content
+            if stream:
+                print(chunk.choices[0].text, end="", flush=True)
+            if cancel is not None and cancel.is_set():
+                response.close()
+                return response_content
     else:
-        return response.choices[0].text
+        response_content = response.choices[0].text
+    if cache is not None and (validate is None or validate(response_content)):
+        cache.put(cache_key, response_content)
+    return response_content
 
 
-def batch_completion(agent, model_name, prompts: list, max_tokens: int = 10000, top_p: float = 0.8, temperature: float = 0.7, repetition_penalty: float = 1.05, min_p: float = 0.05, top_k: int = 20) -> list:
-    """Process multiple prompts in parallel using ThreadPoolExecutor"""
-    print(f"Processing {len(prompts)} prompts in parallel...")
-    results = [None] * len(prompts)  # Initialize a list with the same length as prompts
-    
-    # Define a worker function for threading
-    def worker(index, prompt):
-        result = stream_completion(
-            agent=agent,
-            model_name=model_name,
-            prompt=prompt,
-            max_tokens=max_tokens,
-            top_p=top_p,
-            temperature=temperature,
-            repetition_penalty=repetition_penalty,
-            min_p=min_p,
-            top_k=top_k,
-            stream=False  # Disable streaming for batch processing
-        )
-        results[index] = result
-    
-    # Use ThreadPoolExecutor for concurrent requests
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Map each prompt to the worker function
-        futures = {executor.submit(worker, idx, prompt): idx for idx, prompt in enumerate(prompts)}
-        
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()  # Get task result, exceptions will be caught if thrown
-            except Exception as exc:
-                print(f'Generated an exception: {exc}')
-                idx = futures[future]
-                results[idx] = None
-    
-    return results
-
 if __name__ == "__main__":
     text = "# Example ISBN-like numbers (replace with actual data if available)\nisbn_numbers = [\n    '9780306406157',\n    '9780306406517',\n    '9780306406127'\n]\n\n# Search for possible (weight, transposed_column) pairs\ndef check_isbn_pair(isbn_list):\n    valid_pairs = []\n    for weight in range(1, 10):\n        for col in range(3, 11):\n            all_valid = True\n            for isbn in isbn_list:\n                digits = [int(x) for x in isbn]\n                # Transpose columns col and col+1\n                if col+1 >= len(digits):\n                    all_valid = False\n                    break\n                digits[col], digits[col+1] = digits[col+1], digits[col]\n                # Calculate checksum with the unknown weight at col\n                checksum = sum(d * (i+1 if i != col else weight) for i, d in enumerate(digits[:-1]))\n                if checksum % 11 != digits[-1]:\n                    all_valid = False\n                    break\n            if all_valid:\n                valid_pairs.append((weight, col))\n    print(valid_pairs)\n\ncheck_isbn_pair(isbn_numbers)"
     print(safe_exec(text))
\ No newline at end of file
@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils import clean_webpage_content
+
+def load_jsonl(file_path):
+    with open(file_path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def legacy_clean_webpage_content(content: str) -> str:
+    """The nine-pass cleaner clean_webpage_content replaced, kept as the reference."""
+    if not content:
+        return ""
+    url_pattern = r'https?://[^\s<>"{}|\\^`\[\]]+|ftp://[^\s<>"{}|\\^`\[\]]+|www\.[^\s<>"{}|\\^`\[\]]+'
+    content = re.sub(url_pattern, '', content)
+    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+    content = re.sub(email_pattern, '', content)
+    placeholder_patterns = [
+        (r'\.{2,}', '.'),
+        (r'-{2,}', '-'),
+        (r'_{2,}', '_'),
+        (r'\*{2,}', '*'),
+        (r'={2,}', '='),
+        (r'\n{2,}', '\n'),
+        (r'\s{2,}', ' '),
+    ]
+    for pattern, replacement in placeholder_patterns:
+        content = re.sub(pattern, replacement, content)
+    return content.strip()
+
+def timed(fn, pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            fn(page)
+    return (time.perf_counter() - start) / repeat
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark clean_webpage_content on cached pages")
+    parser.add_argument("--data", type=str, default="data/cached.jsonl", help="JSONL file of cached pages")
+    parser.add_argument("--content_key", type=str, default="content", help="Key holding the page text")
+    parser.add_argument("--max_content_length", type=int, default=30000, help="Truncation length used by the search nodes")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed passes over the corpus")
+    args = parser.parse_args()
+
+    pages = [item.get(args.content_key) or "" for item in load_jsonl(args.data)]
+    print(f"{len(pages)} pages, {sum(len(page) for page in pages) / 1024 / 1024:.1f} MB")
+
+    mismatches = 0
+    for page in pages:
+        expected = legacy_clean_webpage_content(page)
+        if clean_webpage_content(page) != expected or clean_webpage_content(page, args.max_content_length) != expected[:args.max_content_length]:
+            mismatches += 1
+    print(f"mismatches: {mismatches}")
+
+    legacy = timed(lambda page: legacy_clean_webpage_content(page)[:args.max_content_length], pages, args.repeat)
+    full = timed(clean_webpage_content, pages, args.repeat)
+    truncated = timed(lambda page: clean_webpage_content(page, args.max_content_length), pages, args.repeat)
+    print(f"legacy:                 {legacy:.3f}s")
+    print(f"compiled (full page):   {full:.3f}s ({legacy / full:.2f}x)")
+    print(f"compiled (truncated):   {truncated:.3f}s ({legacy / truncated:.2f}x)")
@@ -32,6 +32,16 @@ def build_db(db_name):
             metainfo JSON
         )
     """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS query_cache (
+            cache_key CHAR(64) PRIMARY KEY,
+            query TEXT,
+            topk INT,
+            response LONGTEXT,
+            expires_at DOUBLE,
+            INDEX (expires_at)
+        )
+    """)
     # Print page_results table length
     cursor.execute("SELECT COUNT(*) FROM page_results;")
     count = cursor.fetchone()[0]
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+import aiomysql
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query so trivially different spellings share one cache entry."""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+class QueryCache:
+    """Two-tier cache of /search_v1 responses, keyed by normalized query and topk.
+
+    An in-process LRU answers repeated queries without a round trip; the
+    `query_cache` MySQL table keeps entries across restarts and processes.
+    Responses without results are cached too, with a shorter TTL; callers only
+    store responses whose search and page fetches succeeded.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 7 * 24 * 3600, negative_ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def create_table(self, db_pool: aiomysql.Pool):
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS query_cache (
+                        cache_key CHAR(64) PRIMARY KEY,
+                        query TEXT,
+                        topk INT,
+                        response LONGTEXT,
+                        expires_at DOUBLE,
+                        INDEX (expires_at)
+                    )
+                """)
+
+    @staticmethod
+    def make_key(query: str, topk: int) -> str:
+        return hashlib.sha256(f"{normalize_query(query)}\x00{topk}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, expires_at: float, response: dict):
+        self.entries[key] = (expires_at, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _hit(self, response: dict) -> dict:
+        if not response["results"]:
+            self.negative_hits += 1
+        return response
+
+    async def get(self, key: str, db_pool: aiomysql.Pool) -> Optional[dict]:
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return self._hit(entry[1])
+            del self.entries[key]
+
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT response, expires_at FROM query_cache WHERE cache_key = %s", (key,))
+                row = await cursor.fetchone()
+        if row is not None and row[1] > now:
+            response = json.loads(row[0])
+            self._remember(key, row[1], response)
+            self.db_hits += 1
+            return self._hit(response)
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, query: str, topk: int, response: dict, db_pool: aiomysql.Pool):
+        expires_at = time.time() + (self.ttl if response["results"] else self.negative_ttl)
+        self._remember(key, expires_at, response)
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "INSERT INTO query_cache (cache_key, query, topk, response, expires_at) VALUES (%s, %s, %s, %s, %s) "
+                    "ON DUPLICATE KEY UPDATE response = VALUES(response), expires_at = VALUES(expires_at)",
+                    (key, query, topk, json.dumps(response, ensure_ascii=False), expires_at)
+                )
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.db_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+        }
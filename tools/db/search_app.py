@@ -1,39 +1,78 @@
 from tools.search import (
     extract_relevant_info, 
-    fetch_page_content,
+    fetch_page_content_async,
     extract_snippet_with_context,
-    google_search_async 
+    google_search_async,
+    close_search_session
 )   
+from tools.db.query_cache import QueryCache
 import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
 from typing import List
 import json
-import mysql.connector
+import aiomysql
 from fastapi import FastAPI, Query
 from typing import Optional
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from dedup import canonicalize_url
+
 api_dict = json.load(open("data/api_dict.json"))
 
-def connect_to_db():
-    conn = mysql.connector.connect(
+# Connections kept open by the service; every request borrows one instead of connecting
+DB_POOL_SIZE = 32
+db_pool: Optional[aiomysql.Pool] = None
+
+# Length of the url key of page_results
+PAGE_URL_MAX_LENGTH = 512
+PAGE_RESULTS_UPSERT = (
+    "INSERT INTO page_results (url, title, snippet, content, metainfo) VALUES (%s, %s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE title = VALUES(title), snippet = VALUES(snippet), "
+    "content = VALUES(content), metainfo = VALUES(metainfo)"
+)
+
+# Cache of whole /search_v1 responses; TTLs are in seconds
+query_cache_config = api_dict.get("query_cache", {})
+query_cache = QueryCache(
+    max_entries=query_cache_config.get("max_entries", 10000),
+    ttl=query_cache_config.get("ttl", 7 * 24 * 3600),
+    negative_ttl=query_cache_config.get("negative_ttl", 3600),
+)
+
+async def create_db_pool() -> aiomysql.Pool:
+    return await aiomysql.create_pool(
         host=api_dict["db"]["root"]["host"],
         port=api_dict["db"]["root"]["port"],
         user=api_dict["db"]["root"]["user"],
         password=api_dict["db"]["root"]["password"],
-        database="search"
+        db="search",
+        charset="utf8mb4",
+        autocommit=True,
+        minsize=1,
+        maxsize=DB_POOL_SIZE,
     )
-    cursor = conn.cursor()
-    return conn, cursor
 
-async def web_search(query: str) -> List[str]:
-    # Connect to MySQL database
-    conn, cursor = connect_to_db()
+def is_fetch_error(context: str) -> bool:
+    """Whether a page context is the error message of a failed fetch rather than page text"""
+    return context.startswith(("Error", "WebParserClient error"))
 
-    # Check if results exist in database
-    cursor.execute("SELECT results FROM search_results WHERE query = %s", (query,))
-    result = cursor.fetchone()
+async def web_search(query: str, fresh: bool = False) -> Optional[List[str]]:
+    """Search results of the query, or None if the search engine request failed
 
-    if result:
-        return extract_relevant_info(json.loads(result[0]))
+    With `fresh`, stored results are ignored and the search engine is asked again; the
+    search_results table has no expiry, so callers with their own TTL must pass it.
+    """
+    if not fresh:
+        # Check if results exist in database
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT results FROM search_results WHERE query = %s", (query,))
+                result = await cursor.fetchone()
+
+        if result:
+            return extract_relevant_info(json.loads(result[0]))
     
     # If not found, perform Google search
     results = await google_search_async(
@@ -41,18 +80,45 @@ async def web_search(query: str) -> List[str]:
         api_dict["search_engine"]["google_news"]["api_key"], 
         api_dict["search_engine"]["google_news"]["cse_id"]
     )
-    
+    if not results:
+        # the request failed; an answer without results still has other keys
+        return None
 
     # Store results in database
-    cursor.execute(
-        "INSERT INTO search_results (query, results) VALUES (%s, %s)",
-        (query, json.dumps(results))
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "INSERT INTO search_results (query, results) VALUES (%s, %s) "
+                "ON DUPLICATE KEY UPDATE results = VALUES(results)",
+                (query, json.dumps(results))
+            )
     return extract_relevant_info(results)
 
+async def insert_page_results(rows: List[tuple]) -> List[tuple]:
+    """Upsert page rows in one multi-row statement, falling back to one row at a time if it fails
+
+    Returns:
+        List[tuple]: The rows stored
+    """
+    async def insert(batch):
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(PAGE_RESULTS_UPSERT, batch)
+
+    try:
+        await insert(rows)
+        return rows
+    except Exception as e:
+        print(f"Error inserting page results, retrying row by row: {e}")
+    inserted = []
+    for row in rows:
+        try:
+            await insert([row])
+            inserted.append(row)
+        except Exception as e:
+            print(f"Error inserting page result {row[0]}: {e}")
+    return inserted
+
 async def fetch_and_extract_context(results: dict) -> List[dict]:
     """
     Fetch and extract context for each search result.
@@ -64,64 +130,81 @@ async def fetch_and_extract_context(results: dict) -> List[dict]:
     Returns:
         List[dict]: List of search results with added context
     """
-    # Connect to database
-    conn, cursor = connect_to_db()
-    
-    # Extract URLs and snippets from results
-    urls_to_fetch = []
-    
-    for item in results:
-        url = item.get('url')
-        if url:
-            # Check if URL exists in database
-            cursor.execute("SELECT content FROM page_results WHERE url = %s", (url,))
-            db_result = cursor.fetchone()
-            
-            if db_result:
-                # Use existing result from database
-                item['context'] = db_result[0]
-            else:
-                # Add to fetch list
-                urls_to_fetch.append(url)
-    
+    # Pages are stored under the URL they were returned with; the canonical form only matches
+    # variants of one page within the results, and rows stored under the canonical URL
+    canonical = {item['url']: canonicalize_url(item['url']) for item in results if item.get('url')}
+    if not canonical:
+        return results
+    lookup_urls = list(dict.fromkeys(list(canonical) + list(canonical.values())))
+
+    # Look up every URL in a single query
+    async with db_pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                f"SELECT url, content FROM page_results WHERE url IN ({', '.join(['%s'] * len(lookup_urls))})",
+                lookup_urls
+            )
+            cached = {canonicalize_url(url): content for url, content in await cursor.fetchall()}
+
+    # Fetch each missing page once, under the first URL variant it was returned with
+    urls_to_fetch = {}
+    for url, canonical_url in canonical.items():
+        if canonical_url not in cached:
+            urls_to_fetch.setdefault(canonical_url, url)
+    contents = {}
     if urls_to_fetch:
         # Fetch content for missing URLs
-        contents = fetch_page_content(
-            urls=urls_to_fetch,
+        fetched = await fetch_page_content_async(
+            urls=list(urls_to_fetch.values()),
             use_jina=True,
             jina_api_key=api_dict["jina"]["api_key"],
             show_progress=True
         )
-        
-        # Store new results in database and add context to results
-        for item in results:
-            url = item.get('url')
-            if url in contents:
-                item['context'] = contents[url]
-                # Store complete item info in database
-                try:
-                    cursor.execute(
-                    "INSERT INTO page_results (url, title, snippet, content, metainfo) VALUES (%s, %s, %s, %s, %s)",
-                        (url, item.get('title', ''), item.get('snippet', ''), contents[url], json.dumps(item))
-                    )
-                    with open("data/incremental_search.jsonl", "a") as f:
-                        f.write(json.dumps({
-                            "url": url,
-                            "title": item.get('title', ''),
-                            "snippet": item.get('snippet', ''),
-                            "content": contents[url],
-                        }) + "\n")
-                except Exception as e:
-                    print(f"Error inserting page results: {e}")
-                    continue
-        conn.commit()
-    
-    cursor.close()
-    conn.close()
+        contents = {canonical_url: fetched[url] for canonical_url, url in urls_to_fetch.items() if url in fetched}
+
+    rows = []
+    stored = set()
+    for item in results:
+        url = canonical.get(item.get('url'))
+        if url in cached:
+            # Use existing result from database
+            item['context'] = cached[url]
+        elif url in contents:
+            item['context'] = contents[url]
+            if url not in stored and not is_fetch_error(contents[url]):
+                stored.add(url)
+                rows.append((item['url'], item.get('title', ''), item.get('snippet', ''), contents[url], json.dumps(item)))
+
+    # longer URLs do not fit the url key and would fail the whole multi-row insert
+    rows = [row for row in rows if len(row[0]) <= PAGE_URL_MAX_LENGTH]
+    if rows:
+        inserted = await insert_page_results(rows)
+        try:
+            with open("data/incremental_search.jsonl", "a") as f:
+                for url, title, snippet, content, _ in inserted:
+                    f.write(json.dumps({
+                        "url": url,
+                        "title": title,
+                        "snippet": snippet,
+                        "content": content,
+                    }) + "\n")
+        except Exception as e:
+            print(f"Error writing incremental search results: {e}")
+
     return results
 
 
-app = FastAPI(title="Search API", description="API for web search and content extraction")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global db_pool
+    db_pool = await create_db_pool()
+    await query_cache.create_table(db_pool)
+    yield
+    await close_search_session()
+    db_pool.close()
+    await db_pool.wait_closed()
+
+app = FastAPI(title="Search API", description="API for web search and content extraction", lifespan=lifespan)
 
 @app.get("/search_v1")
 async def search(
@@ -138,8 +221,19 @@ async def search(
     Returns:
         List of search results with context
     """
-    # Perform web search
-    search_results = await web_search(query)
+    cache_key = query_cache.make_key(query, topk)
+    try:
+        cached = await query_cache.get(cache_key, db_pool)
+    except Exception as e:
+        print(f"Error reading query cache: {e}")
+        cached = None
+    if cached is not None:
+        return {**cached, "query": query}
+
+    # Perform web search; a query cache miss (or expiry) must reach the search engine
+    search_results = await web_search(query, fresh=True)
+    if search_results is None:
+        return {"query": query, "total_results": 0, "results": []}
     
     # Get top k results
     top_results = search_results[:topk]
@@ -147,11 +241,23 @@ async def search(
     # Fetch and extract context for results
     results_with_context = await fetch_and_extract_context(top_results)
     
-    return {
+    response = {
         "query": query,
         "total_results": len(results_with_context),
         "results": results_with_context
     }
+    # responses with failed page fetches are served but not cached
+    if not any(is_fetch_error(item.get('context', '')) for item in results_with_context):
+        try:
+            await query_cache.put(cache_key, query, topk, response, db_pool)
+        except Exception as e:
+            print(f"Error writing query cache: {e}")
+    return response
+
+@app.get("/cache_stats")
+async def cache_stats():
+    """Hit-rate metrics of the query cache"""
+    return query_cache.stats()
 
 if __name__ == "__main__":
     import uvicorn
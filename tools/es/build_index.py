@@ -1,9 +1,15 @@
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers, NotFoundError
 import requests
 import json
 import asyncio
+import argparse
+import os
+import sys
 import tiktoken
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from dedup import canonicalize_url
+
 def get_tokenizer(model: str = "gpt-3.5-turbo"):
     return tiktoken.encoding_for_model(model)
 
@@ -11,24 +17,63 @@ def load_jsonl(file_path):
     with open(file_path, "r") as f:
         return [json.loads(line) for line in f]
 
+def iter_jsonl_chunks(file_path, chunk_size=1000, offset=0):
+    """Lazily read a JSONL file in chunks, starting at byte `offset`
+
+    Yields:
+        (docs, end_offset): up to chunk_size parsed lines and the byte offset right after them
+    """
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        docs = []
+        for line in iter(f.readline, b""):
+            if line.strip():
+                docs.append(json.loads(line))
+            if len(docs) >= chunk_size:
+                yield docs, f.tell()
+                docs = []
+        if docs:
+            yield docs, f.tell()
+
 tokenizer = get_tokenizer()
 es = Elasticsearch("http://localhost:9311")
 
 import aiohttp
 from openai import AsyncOpenAI
 
-async def get_embedding_from_vllm(text):
-    """Get embedding from vllm service running on localhost:8000"""
-    client = AsyncOpenAI(
-        api_key="not-needed",
-        base_url="http://localhost:25883/v1/"
-    )
-    
-    response = await client.embeddings.create(
-            input=text,
+# Embedding requests are sized by total tokens; each text is truncated to EMBEDDING_MAX_TOKENS first
+EMBEDDING_MAX_TOKENS = 1024
+EMBEDDING_BATCH_TOKENS = 32768
+EMBEDDING_BATCH_SIZE = 128
+# Attempts at embedding a batch before its documents are reported as failed
+EMBEDDING_RETRIES = 3
+# Threads and maximum documents per request used by helpers.parallel_bulk
+BULK_WORKERS = 4
+BULK_CHUNK_SIZE = 500
+
+embedding_client = None
+
+def get_embedding_client() -> AsyncOpenAI:
+    """Return the client shared by every embedding request, creating it on first use."""
+    global embedding_client
+    if embedding_client is None:
+        embedding_client = AsyncOpenAI(
+            api_key="not-needed",
+            base_url="http://localhost:25883/v1/"
+        )
+    return embedding_client
+
+async def get_embeddings_from_vllm(texts):
+    """Get embeddings for a list of texts in one request to the vllm service running on localhost:25883"""
+    response = await get_embedding_client().embeddings.create(
+            input=texts,
             model="bge-m3" # The model name will be det ermined by what's running on vLLM
         )
-    return response.data[0].embedding
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+async def get_embedding_from_vllm(text):
+    """Get embedding from vllm service running on localhost:25883"""
+    return (await get_embeddings_from_vllm([text]))[0]
 
 def create_index(index_name="webpage"):
     """Create Elasticsearch index with mappings
@@ -44,7 +89,14 @@ def create_index(index_name="webpage"):
                 "snippet": {"type": "text"},
                 "title": {"type": "text"}, 
                 "content": {"type": "text"},
-                "content_embedding": {"type": "dense_vector", "dims": 1024}
+                # indexed HNSW graph, so kNN search does not score every document
+                "content_embedding": {
+                    "type": "dense_vector",
+                    "dims": 1024,
+                    "index": True,
+                    "similarity": "cosine",
+                    "index_options": {"type": "hnsw", "m": 16, "ef_construction": 100}
+                }
             }
         }
     }
@@ -57,6 +109,103 @@ def truncate_text(text, max_length=1024):
     """Truncate text to max_length"""
     return tokenizer.decode(tokenizer.encode(text)[:max_length])
 
+def make_embedding_batches(docs):
+    """Group documents into embedding batches of at most EMBEDDING_BATCH_TOKENS tokens
+
+    Yields:
+        (docs, texts): the documents of a batch and their truncated contents
+    """
+    batch_docs, batch_texts, batch_tokens = [], [], 0
+    for doc in docs:
+        tokens = tokenizer.encode(doc["content"], disallowed_special=())[:EMBEDDING_MAX_TOKENS]
+        if batch_docs and (batch_tokens + len(tokens) > EMBEDDING_BATCH_TOKENS or len(batch_docs) >= EMBEDDING_BATCH_SIZE):
+            yield batch_docs, batch_texts
+            batch_docs, batch_texts, batch_tokens = [], [], 0
+        batch_docs.append(doc)
+        batch_texts.append(tokenizer.decode(tokens) or " ")
+        batch_tokens += len(tokens)
+    if batch_docs:
+        yield batch_docs, batch_texts
+
+def bulk_index(docs, embeddings, index_name, batch_num, bulk_workers=BULK_WORKERS):
+    """Bulk index one batch of documents with their embeddings, returning the documents indexed
+
+    Documents are keyed by canonical URL, so indexing a page twice, or under a variant of its URL,
+    overwrites it instead of duplicating it. The batch is split into one request per worker.
+    """
+    def actions():
+        for doc, embedding in zip(docs, embeddings):
+            action = {"_index": index_name, "_source": {**doc, "content_embedding": embedding}}
+            if doc.get("url"):
+                action["_id"] = canonicalize_url(doc["url"])
+            yield action
+
+    chunk_size = min(BULK_CHUNK_SIZE, max(1, -(-len(docs) // bulk_workers)))
+    indexed = []
+    try:
+        # parallel_bulk reports the documents in the order they were given
+        for doc, (ok, info) in zip(docs, helpers.parallel_bulk(es, actions(), thread_count=bulk_workers, chunk_size=chunk_size, raise_on_error=False)):
+            if ok:
+                indexed.append(doc)
+            else:
+                print(f"Failed to index document in batch {batch_num}: {info}")
+        print(f"Successfully indexed {len(indexed)} webpages in batch {batch_num}")
+    except Exception as e:
+        print(f"Error bulk indexing batch {batch_num}: {e}")
+    return indexed
+
+async def embed_and_index(docs, index_name="webpage", bulk_workers=BULK_WORKERS):
+    """Embed documents in token-sized batches and bulk index them, returning the documents indexed
+
+    Bulk indexing of a batch runs in a worker thread while the next batch is being embedded,
+    so the embedding server is kept busy. A batch is embedded up to EMBEDDING_RETRIES times;
+    documents of a batch that still failed are left out of the result.
+    """
+    indexed = []
+    indexing = None
+    for batch_num, (batch_docs, texts) in enumerate(make_embedding_batches(docs), 1):
+        print(f"Processing batch {batch_num} ({len(batch_docs)} documents)")
+        embeddings = None
+        for attempt in range(1, EMBEDDING_RETRIES + 1):
+            try:
+                embeddings = await get_embeddings_from_vllm(texts)
+                break
+            except Exception as e:
+                print(f"Error getting embeddings for batch {batch_num} (attempt {attempt}/{EMBEDDING_RETRIES}): {e}")
+                if attempt < EMBEDDING_RETRIES:
+                    await asyncio.sleep(2 ** attempt)
+        if embeddings is None:
+            continue
+        if indexing is not None:
+            indexed += await indexing
+        indexing = asyncio.create_task(asyncio.to_thread(bulk_index, batch_docs, embeddings, index_name, batch_num, bulk_workers))
+    if indexing is not None:
+        indexed += await indexing
+    return indexed
+
+def get_existing_urls(urls, index_name="webpage", batch_size=1000):
+    """Return the canonical URLs that already have a document in the index
+
+    Looked up with a terms query on the `url` field for every URL and its canonical form, so
+    documents indexed under an auto-generated _id or a raw URL are found too.
+    """
+    existing_urls = set()
+    for i in range(0, len(urls), batch_size):
+        batch = urls[i:i+batch_size]
+        terms = list(dict.fromkeys(batch + [canonicalize_url(url) for url in batch]))
+        try:
+            response = es.search(
+                index=index_name,
+                query={"terms": {"url": terms}},
+                source=["url"],
+                size=len(terms),
+            )
+        except NotFoundError:
+            # the index does not exist yet
+            return existing_urls
+        existing_urls.update(canonicalize_url(hit["_source"]["url"]) for hit in response["hits"]["hits"])
+    return existing_urls
+
 async def index_documents(data, index_name="webpage"):
     """Index documents into Elasticsearch with embeddings
     
@@ -64,168 +213,131 @@ async def index_documents(data, index_name="webpage"):
         data: List of dicts with keys: url, snippet, title, content
         index_name: Name of the ES index to index into
     """
-    # Process in batches of 100 documents
-    batch_size = 25
-    for i in range(0, len(data), batch_size):
-        print(f"Processing batch {i//batch_size + 1} of {len(data)//batch_size}")
-        batch = data[i:i+batch_size]
-        
-        # Get embeddings for current batch
-        valid_data = []
-        embedding_tasks = []
-        for item in batch:
-            try:
-                embedding_tasks.append(get_embedding_from_vllm(truncate_text(item["content"])))
-                valid_data.append(item)
-            except Exception as e:
-                print(f"Error processing item: {e}")
-                continue
-                
-        embeddings = await asyncio.gather(*embedding_tasks)
-
-        # Build bulk data for current batch
-        bulk_data = []
-        for doc, embedding in zip(valid_data, embeddings):
-            doc["content_embedding"] = embedding
-            bulk_data.append({"index": {"_index": index_name}})
-            bulk_data.append(doc)
-        
-        # Bulk index current batch
-        es.bulk(body=bulk_data)
-        es.indices.refresh(index=index_name)
+    await embed_and_index(data, index_name)
+    es.indices.refresh(index=index_name)
 
-async def add_webpages_to_index(webpages, index_name="webpage"):
+async def add_webpages_to_index(webpages, index_name="webpage", bulk_workers=BULK_WORKERS, refresh=True):
     """Add a list of webpages to the Elasticsearch index
     
     Args:
         webpages: List of dicts with keys: url, title, snippet, content
         index_name: Name of the ES index to add to (defaults to "webpage")
+        bulk_workers: Threads used for bulk indexing
+        refresh: Refresh the index once the webpages are added
+
+    Returns:
+        (added, failed): numbers of webpages indexed and of new webpages that failed to be indexed
     """
     if not webpages:
         print("No webpages to add")
-        return
+        return 0, 0
         
     print(f"Adding {len(webpages)} webpages to index '{index_name}'")
     
-    # Check existing URLs in the index
-    existing_urls = set()
+    # Check which URLs are already in the index
+    urls = list(dict.fromkeys(webpage["url"] for webpage in webpages if webpage.get("url")))
     try:
-        # Get all existing URLs using scroll API
-        query = {
-            "query": {"match_all": {}},
-            "_source": ["url"]
-        }
-        scroll_response = es.search(
-            index=index_name,
-            body=query,
-            scroll='2m',
-            size=1000
-        )
-        
-        while True:
-            for hit in scroll_response['hits']['hits']:
-                existing_urls.add(hit['_source']['url'])
-            
-            scroll_id = scroll_response['_scroll_id']
-            scroll_response = es.scroll(scroll_id=scroll_id, scroll='2m')
-            
-            if not scroll_response['hits']['hits']:
-                break
-                
+        existing_urls = get_existing_urls(urls, index_name)
         print(f"Found {len(existing_urls)} existing URLs in index")
     except Exception as e:
-        print(f"Error checking existing URLs (index might not exist): {e}")
+        print(f"Error checking existing URLs: {e}")
         existing_urls = set()
     
     # Filter out webpages with existing URLs
     new_webpages = []
     skipped_count = 0
     for webpage in webpages:
-        if webpage.get("url") in existing_urls:
+        url = canonicalize_url(webpage.get("url") or "")
+        if url in existing_urls:
             skipped_count += 1
             continue
-        existing_urls.add(webpage.get("url"))
+        existing_urls.add(url)
         new_webpages.append(webpage)
-    with open("data/existing_urls.txt", "w") as f:
-        for url in existing_urls:
-            f.write(url + "\n")
     print(f"Skipped {skipped_count} webpages with existing URLs")
     print(f"Processing {len(new_webpages)} new webpages")
     
     if not new_webpages:
         print("No new webpages to add")
-        return
+        return 0, 0
     
-    # Process in batches
-    batch_size = 100
-    total_processed = 0
-    
-    for i in range(0, len(new_webpages), batch_size):
-        batch = new_webpages[i:i+batch_size]
-        print(f"Processing batch {i//batch_size + 1} of {(len(new_webpages)-1)//batch_size + 1}")
-        
-        # Get embeddings for current batch
-        valid_data = []
-        embedding_tasks = []
-        
-        for webpage in batch:
-            try:
-                # Validate required keys
-                if not all(key in webpage for key in ["url", "title", "snippet", "content"]):
-                    print(f"Skipping webpage missing required keys: {webpage.get('url', 'unknown')}")
-                    continue
-                    
-                embedding_tasks.append(get_embedding_from_vllm(truncate_text(webpage["content"])))
-                valid_data.append(webpage)
-            except Exception as e:
-                print(f"Error processing webpage {webpage.get('url', 'unknown')}: {e}")
-                continue
-        
-        if not valid_data:
-            continue
-            
-        # Get embeddings
-        try:
-            embeddings = await asyncio.gather(*embedding_tasks)
-        except Exception as e:
-            print(f"Error getting embeddings for batch: {e}")
+    # Validate required keys
+    valid_data = []
+    for webpage in new_webpages:
+        if not all(key in webpage for key in ["url", "title", "snippet", "content"]):
+            print(f"Skipping webpage missing required keys: {webpage.get('url', 'unknown')}")
             continue
+        valid_data.append(webpage)
 
-        # Build bulk data for current batch
-        bulk_data = []
-        for webpage, embedding in zip(valid_data, embeddings):
-            webpage_doc = webpage.copy()
-            webpage_doc["content_embedding"] = embedding
-            bulk_data.append({"index": {"_index": index_name}})
-            bulk_data.append(webpage_doc)
-            # print(webpage_doc)
-        
-        # Bulk index current batch
-        try:
-            response = es.bulk(body=bulk_data)
-            print(response)
-            if response.get("errors"):
-                print(f"Some documents failed to index in batch {i//batch_size + 1}")
-            total_processed += len(valid_data)
-            print(f"Successfully indexed {len(valid_data)} webpages (total: {total_processed})")
-        except Exception as e:
-            print(f"Error bulk indexing batch: {e}")
-            continue
+    indexed = await embed_and_index(valid_data, index_name, bulk_workers)
+    total_processed = len(indexed)
+    with open("data/existing_urls.txt", "a") as f:
+        for webpage in indexed:
+            f.write(canonicalize_url(webpage["url"]) + "\n")
+    if total_processed < len(valid_data):
+        print(f"Failed to index {len(valid_data) - total_processed} webpages")
     
     # Refresh index
-    try:
-        es.indices.refresh(index=index_name)
-        print(f"Index refresh completed. Total new webpages added: {total_processed}")
-    except Exception as e:
-        print(f"Error refreshing index: {e}")
+    if refresh:
+        try:
+            es.indices.refresh(index=index_name)
+            print(f"Index refresh completed. Total new webpages added: {total_processed}")
+        except Exception as e:
+            print(f"Error refreshing index: {e}")
+    return total_processed, len(valid_data) - total_processed
+
+def load_offset(offset_file, file_path):
+    """Byte offset to resume ingesting `file_path` from, recorded by an earlier run"""
+    if not os.path.exists(offset_file):
+        return 0
+    with open(offset_file, "r") as f:
+        state = json.load(f)
+    return state["offset"] if state.get("file") == os.path.abspath(file_path) else 0
+
+def save_offset(offset_file, file_path, offset):
+    with open(offset_file + ".tmp", "w") as f:
+        json.dump({"file": os.path.abspath(file_path), "offset": offset}, f)
+    os.replace(offset_file + ".tmp", offset_file)
 
+async def ingest_jsonl(file_path, index_name="webpage", chunk_size=1000, bulk_workers=BULK_WORKERS, offset_file=None):
+    """Stream a JSONL corpus into the index chunk by chunk, keeping memory flat
+
+    With `offset_file`, the byte offset after every fully indexed chunk is recorded there and
+    a later run resumes from it. Ingestion stops at the first chunk with webpages that failed
+    to be indexed, so a later run retries them; pages of that chunk that were indexed are skipped.
+    """
+    offset = load_offset(offset_file, file_path) if offset_file else 0
+    if offset:
+        print(f"Resuming {file_path} from byte offset {offset}")
+    total_processed = 0
+    for docs, end_offset in iter_jsonl_chunks(file_path, chunk_size, offset):
+        added, failed = await add_webpages_to_index(docs, index_name, bulk_workers, refresh=False)
+        total_processed += added
+        if failed:
+            print(f"Stopping at byte offset {offset}: {failed} webpages of this chunk failed to be indexed, rerun to retry them")
+            break
+        offset = end_offset
+        if offset_file:
+            save_offset(offset_file, file_path, offset)
+        print(f"Ingested up to byte offset {offset}, total new webpages added: {total_processed}")
+    es.indices.refresh(index=index_name)
+    print(f"Index refresh completed. Total new webpages added: {total_processed}")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a JSONL corpus of webpages into the Elasticsearch index")
+    parser.add_argument("--data", type=str, default="data/cached.jsonl", help="JSONL file of webpages")
+    parser.add_argument("--index_name", type=str, default="webpage", help="Name of the ES index")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="Webpages read from the file at a time")
+    parser.add_argument("--bulk_workers", type=int, default=BULK_WORKERS, help="Threads used for bulk indexing")
+    parser.add_argument("--offset_file", type=str, default="data/build_index.offset", help="Where the resume offset is recorded (empty to disable)")
+    parser.add_argument("--create_index", action="store_true", help="(Re)create the index first")
+    args = parser.parse_args()
+
     # create index for the first time
-     # create_index()
+    if args.create_index:
+        create_index(args.index_name)
+        if args.offset_file and os.path.exists(args.offset_file):
+            os.remove(args.offset_file)
 
     # add cached data to index
-    data = load_jsonl('data/cached.jsonl')
-   
-    asyncio.run(add_webpages_to_index(data))
+    asyncio.run(ingest_jsonl(args.data, args.index_name, args.chunk_size, args.bulk_workers, args.offset_file or None))
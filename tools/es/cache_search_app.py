@@ -1,75 +1,234 @@
-from flask import Flask, request, jsonify
-from elasticsearch import Elasticsearch
-import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from elasticsearch import AsyncElasticsearch, BadRequestError
+from contextlib import asynccontextmanager
 from openai import AsyncOpenAI
+from collections import OrderedDict
+import asyncio
+import json
 import os
+import sqlite3
+import sys
+import threading
 from my_own_tools import *
 
-app = Flask(__name__)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from dedup import canonicalize_url
+
+# Long-lived clients, created once when the service starts
+es: AsyncElasticsearch = None
+embedding_client: AsyncOpenAI = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global es, embedding_client
+    es = AsyncElasticsearch("http://localhost:9311")
+    embedding_client = AsyncOpenAI(
+        api_key="not-needed",
+        base_url="http://localhost:25883/v1"
+    )
+    yield
+    await embedding_client.close()
+    await es.close()
 
-# Initialize Elasticsearch client
-es = Elasticsearch("http://localhost:9311")
+app = FastAPI(title="Cache Search API", description="Search and insert cached webpages in Elasticsearch", lifespan=lifespan)
 
 existing_urls = set()
 with open('data/existing_urls.txt', 'r') as f:
     for line in f:
-        existing_urls.add(line.strip())
+        # older files hold raw URLs; canonicalizing again is a no-op for canonical ones
+        existing_urls.add(canonicalize_url(line.strip()))
 
 # Initialize tokenizer
 tokenizer = get_tokenizer()
 
-async def get_embedding_from_vllm(text):
-    """Get embedding from vllm service running on localhost:25883"""
-    client = AsyncOpenAI(
-        api_key="not-needed",
-        base_url="http://localhost:25883/v1"
-    )
-    
-    response = await client.embeddings.create(
-        input=[text],
+async def get_embeddings_from_vllm(texts):
+    """Get embeddings for a list of texts in one request to the vllm service running on localhost:25883"""
+    response = await embedding_client.embeddings.create(
+        input=texts,
         model="bge-m3"
     )
     
-    return response.data[0].embedding
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+async def get_embedding_from_vllm(text):
+    """Get embedding from vllm service running on localhost:25883"""
+    return (await get_embeddings_from_vllm([text]))[0]
+
+class EmbeddingCache:
+    """LRU cache of query embeddings keyed by the truncated query text.
+
+    With a `path`, embeddings are also kept in a SQLite file, so they survive restarts;
+    the in-memory LRU is bounded by `max_entries`. Methods are thread-safe, so async
+    handlers run the SQLite lookups in worker threads.
+    """
+
+    def __init__(self, max_entries: int = 100000, path: str = ""):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = None
+        self.lock = threading.Lock()
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (text TEXT PRIMARY KEY, embedding TEXT)")
+            self.conn.commit()
+
+    def _remember(self, text, embedding):
+        self.entries[text] = embedding
+        self.entries.move_to_end(text)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_memory(self, text):
+        """Embedding from the in-memory LRU only, never blocking on SQLite"""
+        with self.lock:
+            if text in self.entries:
+                self.entries.move_to_end(text)
+                self.hits += 1
+                return self.entries[text]
+        return None
+
+    def get_disk(self, text):
+        """Embedding from the SQLite file (blocking), counting a miss if absent"""
+        row = None
+        if self.conn is not None:
+            with self.lock:
+                row = self.conn.execute("SELECT embedding FROM embeddings WHERE text = ?", (text,)).fetchone()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            embedding = json.loads(row[0])
+            self._remember(text, embedding)
+            self.disk_hits += 1
+            return embedding
+
+    def get(self, text):
+        embedding = self.get_memory(text)
+        return embedding if embedding is not None else self.get_disk(text)
+
+    def put(self, text, embedding):
+        with self.lock:
+            self._remember(text, embedding)
+            if self.conn is not None:
+                self.conn.execute("INSERT OR REPLACE INTO embeddings (text, embedding) VALUES (?, ?)", (text, json.dumps(embedding)))
+                self.conn.commit()
+
+    def stats(self):
+        hits = self.hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+        }
+
+query_embedding_cache = EmbeddingCache(
+    max_entries=int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 100000)),
+    path=os.environ.get("QUERY_EMBEDDING_CACHE_PATH", ""),
+)
+
+async def get_query_embedding(query):
+    """Embedding of a search query, served from query_embedding_cache when possible"""
+    text = truncate_text(query)
+    embedding = query_embedding_cache.get_memory(text)
+    if embedding is None:
+        # SQLite lookups and writes block, so they run off the event loop
+        embedding = await asyncio.to_thread(query_embedding_cache.get_disk, text)
+    if embedding is None:
+        embedding = await get_embedding_from_vllm(text)
+        await asyncio.to_thread(query_embedding_cache.put, text, embedding)
+    return embedding
 
 def truncate_text(text, max_length=1024):
     """Truncate text to max_length"""
+    # every token covers at least one UTF-8 byte, so short texts need no tokenization
+    if len(text.encode("utf-8")) <= max_length:
+        return text
     return tokenizer.decode(tokenizer.encode(text)[:max_length])
 
-@app.route('/search', methods=['POST'])
-def search():
-    """Search service that retrieves top 10 results from ES webpage index"""
-    try:
-        data = request.get_json()
-        query = data.get('query', '')
-        topk = data.get('topk', 10)
-        
-        if not query:
-            return jsonify({'error': 'Query is required'}), 400
-        
-        # Get embedding for the query
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        query_embedding = loop.run_until_complete(get_embedding_from_vllm(truncate_text(query)))
-        loop.close()
-        
-        # Search in Elasticsearch using vector similarity
-        search_body = {
+# Retrieval strategies of /search: BM25 only, HNSW kNN only, both fused with reciprocal rank
+# fusion, or the original exact cosine rescoring of the BM25 matches
+RETRIEVAL_STRATEGIES = ("hybrid", "knn", "bm25", "script_score")
+DEFAULT_STRATEGY = os.environ.get("CACHE_SEARCH_STRATEGY", "hybrid")
+# Cleared once a kNN search is rejected, e.g. on an index built before the HNSW mapping
+# (dense_vector without index: true); kNN strategies then fall back to script_score
+# until the service is restarted on a rebuilt index
+knn_available = True
+
+class KnnRejectedError(Exception):
+    """A hybrid search whose kNN half the index rejected"""
+# Hits taken from each retriever before fusion, and the RRF rank constant
+RRF_WINDOW = 50
+RRF_K = 60
+
+def bm25_query(query):
+    return {
+        "multi_match": {
+            "query": query,
+            "fields": ["title^2", "content"],
+            "type": "best_fields"
+        }
+    }
+
+def knn_query(query_embedding, k):
+    return {
+        "field": "content_embedding",
+        "query_vector": query_embedding,
+        "k": k,
+        "num_candidates": max(100, k * 10)
+    }
+
+def reciprocal_rank_fusion(hit_lists, k=RRF_K):
+    """Fuse ranked hit lists, scoring each document by the sum of 1 / (k + rank) over the lists"""
+    scores = {}
+    hits = {}
+    for hit_list in hit_lists:
+        for rank, hit in enumerate(hit_list, 1):
+            scores[hit['_id']] = scores.get(hit['_id'], 0.0) + 1.0 / (k + rank)
+            hits.setdefault(hit['_id'], hit)
+    fused = []
+    for doc_id in sorted(scores, key=scores.get, reverse=True):
+        fused.append({**hits[doc_id], '_score': scores[doc_id]})
+    return fused
+
+async def retrieve(query, topk, strategy, query_embedding=None):
+    """Return the top ES hits for `query` with the given retrieval strategy
+
+    kNN strategies fall back to script_score when the index rejects kNN searches.
+    """
+    global knn_available
+    if strategy in ("hybrid", "knn") and knn_available:
+        try:
+            return await _retrieve(query, topk, strategy, query_embedding)
+        except (BadRequestError, KnnRejectedError) as e:
+            knn_available = False
+            print(f"kNN search rejected, falling back to script_score until the index is rebuilt: {e}")
+    if strategy in ("hybrid", "knn"):
+        strategy = "script_score"
+    return await _retrieve(query, topk, strategy, query_embedding)
+
+async def _retrieve(query, topk, strategy, query_embedding=None):
+    source = {"excludes": ["content_embedding"]}
+    if strategy == "bm25":
+        body = {"query": bm25_query(query), "size": topk, "_source": source}
+        return (await es.search(index="webpage", body=body))['hits']['hits']
+    if strategy == "knn":
+        body = {"knn": knn_query(query_embedding, topk), "size": topk, "_source": source}
+        return (await es.search(index="webpage", body=body))['hits']['hits']
+    if strategy == "script_score":
+        body = {
             "query": {
                 "script_score": {
-                    "query": {
-                        "bool": {
-                            "should": [
-                                {
-                                    "multi_match": {
-                                        "query": query,
-                                        "fields": ["title^2", "content"],
-                                        "type": "best_fields"
-                                    }
-                                }
-                            ]
-                        }
-                    },
+                    "query": {"bool": {"should": [bm25_query(query)]}},
                     "script": {
                         "source": "cosineSimilarity(params.query_vector, 'content_embedding') + 1.0",
                         "params": {"query_vector": query_embedding}
@@ -77,15 +236,46 @@ def search():
                 }
             },
             "size": topk,
-            "_source": {
-                "excludes": ["content_embedding"]
-            } 
+            "_source": source
         }
+        return (await es.search(index="webpage", body=body))['hits']['hits']
+
+    # hybrid: run both retrievers in one round trip and fuse their rankings
+    window = max(topk, RRF_WINDOW)
+    responses = (await es.msearch(body=[
+        {"index": "webpage"},
+        {"query": bm25_query(query), "size": window, "_source": source},
+        {"index": "webpage"},
+        {"knn": knn_query(query_embedding, window), "size": window, "_source": source},
+    ]))['responses']
+    for response in responses:
+        if 'error' in response:
+            if response.get('status') == 400:
+                raise KnnRejectedError(response['error'])
+            raise RuntimeError(response['error'])
+    return reciprocal_rank_fusion([response['hits']['hits'] for response in responses])[:topk]
+
+@app.post('/search')
+async def search(request: Request):
+    """Search service that retrieves top 10 results from ES webpage index"""
+    try:
+        data = await request.json()
+        query = data.get('query', '')
+        topk = data.get('topk', 10)
+        strategy = data.get('strategy', DEFAULT_STRATEGY)
         
-        response = es.search(index="webpage", body=search_body)
+        if not query:
+            return JSONResponse({'error': 'Query is required'}, status_code=400)
+        if strategy not in RETRIEVAL_STRATEGIES:
+            return JSONResponse({'error': f'Unknown strategy {strategy}, expected one of {list(RETRIEVAL_STRATEGIES)}'}, status_code=400)
+        
+        # Get embedding for the query
+        query_embedding = None
+        if strategy != "bm25":
+            query_embedding = await get_query_embedding(query)
         
         results = []
-        for hit in response['hits']['hits']:
+        for hit in await retrieve(query, topk, strategy, query_embedding):
             source = hit['_source']
             result = {
                 'title': source.get('title', ''),
@@ -96,20 +286,25 @@ def search():
             }
             results.append(result)
         
-        return jsonify({'results': results})
+        return {'results': results}
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+@app.get('/embedding_cache_stats')
+async def embedding_cache_stats():
+    """Hit-rate and eviction metrics of the query embedding cache"""
+    return query_embedding_cache.stats()
 
-@app.route('/insert', methods=['POST'])
-def insert():
+@app.post('/insert')
+async def insert(request: Request):
     """Insert service that adds new webpages to ES if URL doesn't exist"""
     try:
-        data = request.get_json()
+        data = await request.json()
         webpages = data.get('webpages', [])
         
         if not webpages:
-            return jsonify({'error': 'Webpages list is required'}), 400
+            return JSONResponse({'error': 'Webpages list is required'}, status_code=400)
         
         # Filter new webpages
         new_webpages = []
@@ -120,74 +315,71 @@ def insert():
             if not all(key in webpage for key in ['title', 'url', 'snippet', 'content']):
                 continue
                 
-            if webpage['url'] in existing_urls:
+            url = canonicalize_url(webpage['url'])
+            if url in existing_urls:
                 skipped_count += 1
                 continue
                 
             new_webpages.append(webpage)
-            existing_urls.add(webpage['url'])
+            existing_urls.add(url)
         
         if not new_webpages:
-            return jsonify({
+            return {
                 'message': 'No new webpages to insert',
                 'inserted_count': 0,
                 'skipped_count': skipped_count
-            })
+            }
         
-        # Get embeddings and insert into ES
+        # Get embeddings for all contents in one request
+        try:
+            embeddings = await get_embeddings_from_vllm([truncate_text(webpage['content']) for webpage in new_webpages])
+        except Exception:
+            # the pages were not inserted, so later requests may retry them
+            existing_urls.difference_update(canonicalize_url(webpage['url']) for webpage in new_webpages)
+            raise
+
+        # Prepare documents for ES
         bulk_data = []
-        successful_urls = []
-        
-        # Create event loop for async operations
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        for webpage, embedding in zip(new_webpages, embeddings):
+            doc = {
+                'title': webpage['title'],
+                'url': webpage['url'],
+                'snippet': webpage['snippet'],
+                'content': webpage['content'],
+                'content_embedding': embedding
+            }
+            bulk_data.append({"index": {"_index": "webpage", "_id": canonicalize_url(webpage['url'])}})
+            bulk_data.append(doc)
         
+        # Bulk insert into ES
         try:
-            for webpage in new_webpages:
-                try:
-                    # Get embedding for content
-                    embedding = loop.run_until_complete(get_embedding_from_vllm(truncate_text(webpage['content'])))
-
-                    # Prepare document for ES
-                    doc = {
-                        'title': webpage['title'],
-                        'url': webpage['url'],
-                        'snippet': webpage['snippet'],
-                        'content': webpage['content'],
-                        'content_embedding': embedding
-                    }
-                    
-                    bulk_data.append({"index": {"_index": "webpage", "_id": webpage['url']}})
-                    bulk_data.append(doc)
-                    successful_urls.append(webpage['url'])
-                    
-                except Exception as e:
-                    print(f"Error processing webpage {webpage['url']}: {e}")
-                    continue
-            
-            # Bulk insert into ES
-            inserted_count = 0
-            if bulk_data:
-                response = es.bulk(body=bulk_data)
-                if not response.get("errors"):
-                    inserted_count = len(successful_urls)
-                    # Refresh index
-                    es.indices.refresh(index="webpage")
-                    
-                else:
-                    return jsonify({'error': 'Failed to insert some documents'}), 500
-            
-            return jsonify({
-                'message': f'Successfully inserted {inserted_count} webpages',
-                'inserted_count': inserted_count,
+            response = await es.bulk(body=bulk_data)
+        except Exception:
+            existing_urls.difference_update(canonicalize_url(webpage['url']) for webpage in new_webpages)
+            raise
+        if response.get("errors"):
+            # release only the pages ES rejected; the items are in request order
+            failed = [webpage for webpage, item in zip(new_webpages, response['items']) if 'error' in item['index']]
+            existing_urls.difference_update(canonicalize_url(webpage['url']) for webpage in failed)
+            await es.indices.refresh(index="webpage")
+            return JSONResponse({
+                'error': f'Failed to insert {len(failed)} of {len(new_webpages)} webpages',
+                'inserted_count': len(new_webpages) - len(failed),
                 'skipped_count': skipped_count
-            })
-            
-        finally:
-            loop.close()
+            }, status_code=500)
+        inserted_count = len(new_webpages)
+        # Refresh index
+        await es.indices.refresh(index="webpage")
+        
+        return {
+            'message': f'Successfully inserted {inserted_count} webpages',
+            'inserted_count': inserted_count,
+            'skipped_count': skipped_count
+        }
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return JSONResponse({'error': str(e)}, status_code=500)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=39118)
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=39118)
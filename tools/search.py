@@ -9,6 +9,7 @@ import concurrent
 from concurrent.futures import ThreadPoolExecutor
 import pdfplumber
 from io import BytesIO
+import itertools
 import re
 import string
 from typing import Optional, Tuple
@@ -19,6 +20,8 @@ import aiohttp
 import asyncio
 import chardet
 import random
+import weakref
+import numpy as np
 
 
 # ----------------------- Custom Headers -----------------------
@@ -77,6 +80,49 @@ def f1_score(true_set: set, pred_set: set) -> float:
     recall = intersection / float(len(true_set))
     return 2 * (precision * recall) / (precision + recall)
 
+def score_sentences(full_text: str, snippet_words: set) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Score every sentence of the text against the snippet words with the same F1 as f1_score,
+    numbering the words of the whole text once and counting overlaps with NumPy.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: F1 score, start offset and end offset of each sentence
+    """
+    # Split sentences on the spaces after ., !, ? endings (as re.split(r'(?<=[.!?]) +') does), keeping their offsets
+    boundaries = [m.span(1) for m in re.finditer(r'[.!?]( +)', full_text)]
+    sentence_starts = [0] + [end for _, end in boundaries]
+    sentence_ends = [start for start, _ in boundaries] + [len(full_text)]
+    starts = np.array(sentence_starts, dtype=np.int64)
+    ends = np.array(sentence_ends, dtype=np.int64)
+    f1 = np.zeros(len(starts))
+    if not snippet_words:
+        return f1, starts, ends
+
+    # Normalize and split each sentence exactly as f1_score's callers do, then number the
+    # words of the whole page at once; no marker token, so any text tokenizes identically
+    sentences = [full_text[start:end] for start, end in zip(sentence_starts, sentence_ends)]
+    sentence_tokens = [remove_punctuation(sentence.lower()).split() for sentence in sentences]
+    tokens = list(itertools.chain.from_iterable(sentence_tokens))
+    vocab = list(set(tokens))
+    vocab_ids = dict(zip(vocab, range(len(vocab))))
+    words = np.fromiter(map(vocab_ids.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+    word_sentence = np.repeat(np.arange(len(starts)), list(map(len, sentence_tokens)))
+    if not len(words):
+        return f1, starts, ends
+    in_snippet = np.array([word in snippet_words for word in vocab], dtype=bool)
+
+    # unique (sentence, word) pairs give each sentence's word set
+    pairs = np.sort(word_sentence * len(vocab) + words)
+    pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))]
+    pair_sentence = pairs // len(vocab)
+    sentence_sizes = np.bincount(pair_sentence, minlength=len(starts))
+    intersections = np.bincount(pair_sentence[in_snippet[pairs % len(vocab)]], minlength=len(starts))
+    matched = intersections > 0
+    precision = intersections[matched] / sentence_sizes[matched]
+    recall = intersections[matched] / len(snippet_words)
+    f1[matched] = 2 * (precision * recall) / (precision + recall)
+    return f1, starts, ends
+
 def extract_snippet_with_context(full_text: str, snippet: str, context_chars: int = 3000) -> Tuple[bool, str]:
     """
     Extract the sentence that best matches the snippet and its context from the full text.
@@ -96,24 +142,12 @@ def extract_snippet_with_context(full_text: str, snippet: str, context_chars: in
         snippet = remove_punctuation(snippet)
         snippet_words = set(snippet.split())
 
-        best_sentence = None
-        best_f1 = 0.2
-
-        sentences = re.split(r'(?<=[.!?]) +', full_text)  # Split sentences using regex, supporting ., !, ? endings
-        #sentences = sent_tokenize(full_text)  # Split sentences using nltk's sent_tokenize
-
-        for sentence in sentences:
-            key_sentence = sentence.lower()
-            key_sentence = remove_punctuation(key_sentence)
-            sentence_words = set(key_sentence.split())
-            f1 = f1_score(snippet_words, sentence_words)
-            if f1 > best_f1:
-                best_f1 = f1
-                best_sentence = sentence
+        f1, starts, ends = score_sentences(full_text, snippet_words)
+        best = int(np.argmax(f1)) if len(f1) else 0
 
-        if best_sentence:
-            para_start = full_text.find(best_sentence)
-            para_end = para_start + len(best_sentence)
+        if len(f1) and f1[best] > 0.2:
+            para_start = int(starts[best])
+            para_end = int(ends[best])
             start_index = max(0, para_start - context_chars)
             end_index = min(len(full_text), para_end + context_chars)
             # if end_index - start_index < 2 * context_chars:
@@ -295,37 +329,108 @@ def bing_web_search(query, subscription_key, endpoint, market='en-US', language=
     
     return {}  # Should never reach here but added for completeness
 
-async def google_search_async(query, key, cx, url:str='https://www.googleapis.com/customsearch/v1', timeout=20):
-    params = {
-        'q': query,
-        'key': key,
-        'cx': cx
-    }
-    max_retries = 3
-    retry_count = 0
+# ----------------------- Async search-engine clients -----------------------
+# Concurrent requests allowed per search provider, on each event loop
+SEARCH_CONCURRENCY = {"google": 8, "bing": 8}
+
+# Per-loop state, keyed weakly by the event loop so a new loop reusing a dead loop's id()
+# never gets its session; each loop's session is closed when the loop shuts down
+_search_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = weakref.WeakKeyDictionary()
+_search_closers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Task]" = weakref.WeakKeyDictionary()
+_search_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+_inflight_searches: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[tuple, asyncio.Task]]" = weakref.WeakKeyDictionary()
 
+async def _close_on_shutdown(loop: asyncio.AbstractEventLoop, search_session: aiohttp.ClientSession):
+    """Wait until cancelled, which asyncio.run does to leftover tasks when it shuts the loop down, then close the session."""
+    try:
+        await loop.create_future()
+    finally:
+        if _search_sessions.get(loop) is search_session:
+            del _search_sessions[loop]
+        _search_closers.pop(loop, None)
+        _search_semaphores.pop(loop, None)
+        _inflight_searches.pop(loop, None)
+        await search_session.close()
+
+def get_search_session() -> aiohttp.ClientSession:
+    """Return the aiohttp session shared by the search-engine clients on the running event loop."""
+    loop = asyncio.get_running_loop()
+    search_session = _search_sessions.get(loop)
+    if search_session is None or search_session.closed:
+        search_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300))
+        _search_sessions[loop] = search_session
+        closer = _search_closers.pop(loop, None)
+        if closer is not None:
+            closer.cancel()
+        _search_closers[loop] = loop.create_task(_close_on_shutdown(loop, search_session))
+    return search_session
+
+async def close_search_session():
+    loop = asyncio.get_running_loop()
+    closer = _search_closers.pop(loop, None)
+    search_session = _search_sessions.pop(loop, None)
+    if closer is not None:
+        closer.cancel()
+    if search_session is not None:
+        await search_session.close()
+
+def _get_search_semaphore(provider: str) -> asyncio.Semaphore:
+    semaphores = _search_semaphores.setdefault(asyncio.get_running_loop(), {})
+    if provider not in semaphores:
+        semaphores[provider] = asyncio.Semaphore(SEARCH_CONCURRENCY.get(provider, 8))
+    return semaphores[provider]
+
+def backoff_delay(retry_count: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """Exponential backoff with full jitter, so retrying clients do not hit the provider in lockstep."""
+    return random.uniform(0, min(cap, base * 2 ** retry_count))
+
+async def _search_request(provider: str, name: str, query: str, url: str, params: dict,
+                          headers: Optional[dict] = None, timeout: int = 20, max_retries: int = 3) -> dict:
+    retry_count = 0
     while retry_count < max_retries:
         try:
-            response = requests.get(url, params=params, timeout=timeout)
-            response.raise_for_status()  # Raise exception if the request failed
-            search_results = response.json()
-            return search_results
-        except Timeout:
+            async with _get_search_semaphore(provider):
+                async with get_search_session().get(url, params=params, headers=headers,
+                                                    timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    response.raise_for_status()  # Raise exception if the request failed
+                    return await response.json()
+        except asyncio.TimeoutError:
             retry_count += 1
             if retry_count == max_retries:
-                print(f"Google Search request timed out ({timeout} seconds) for query: {query} after {max_retries} retries")
+                print(f"{name} request timed out ({timeout} seconds) for query: {query} after {max_retries} retries")
                 return {}
-            print(f"Google Search Timeout occurred, retrying ({retry_count}/{max_retries})...")
-        except requests.exceptions.RequestException as e:
-            print(f"Google Search Request Error occurred: {e}")
+            print(f"{name} Timeout occurred, retrying ({retry_count}/{max_retries})...")
+        except (aiohttp.ClientError, ValueError) as e:
             retry_count += 1
             if retry_count == max_retries:
-                print(f"Google Search Request Error occurred: {e} after {max_retries} retries")
+                print(f"{name} Request Error occurred: {e} after {max_retries} retries")
                 return {}
-            print(f"Google Search Request Error occurred, retrying ({retry_count}/{max_retries})...")
-        time.sleep(1)  # Wait 1 second between retries
-    
-    return {}  # Should never reach here but added for completeness
+            print(f"{name} Request Error occurred, retrying ({retry_count}/{max_retries})...")
+        await asyncio.sleep(backoff_delay(retry_count))
+
+    return {}
+
+async def _coalesced_search(key: tuple, make_request) -> dict:
+    """Share one upstream request among all callers asking for the same search at the same time."""
+    inflight = _inflight_searches.setdefault(asyncio.get_running_loop(), {})
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(make_request())
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    # a cancelled caller must not cancel the request the others are waiting on
+    return await asyncio.shield(task)
+
+async def google_search_async(query, key, cx, url:str='https://www.googleapis.com/customsearch/v1', timeout=20):
+    params = {
+        'q': query,
+        'key': key,
+        'cx': cx
+    }
+    return await _coalesced_search(
+        ("google", url, query, key, cx),
+        lambda: _search_request("google", "Google Search", query, url, params, timeout=timeout, max_retries=3)
+    )
 
 def extract_pdf_text(url):
     """
@@ -409,28 +514,14 @@ async def bing_web_search_async(query, subscription_key, endpoint, market='en-US
         "q": query,
         "mkt": market,
         "setLang": language,
-        "textDecorations": True,
+        "textDecorations": "true",
         "textFormat": "HTML"
     }
 
-    max_retries = 5
-    retry_count = 0
-
-    while retry_count < max_retries:
-        try:
-            response = session.get(endpoint, headers=headers, params=params, timeout=timeout)
-            response.raise_for_status()
-            search_results = response.json()
-            return search_results
-        except Exception as e:
-            retry_count += 1
-            if retry_count == max_retries:
-                print(f"Bing Web Search Request Error occurred: {e} after {max_retries} retries")
-                return {}
-            print(f"Bing Web Search Request Error occurred, retrying ({retry_count}/{max_retries})...")
-            time.sleep(1)  # Wait 1 second between retries
-
-    return {}
+    return await _coalesced_search(
+        ("bing", endpoint, query, subscription_key, market, language),
+        lambda: _search_request("bing", "Bing Web Search", query, endpoint, params, headers=headers, timeout=timeout, max_retries=5)
+    )
 
 class RateLimiter:
     def __init__(self, rate_limit: int, time_window: int = 60):
@@ -564,13 +655,17 @@ async def fetch_page_content_async(urls: List[str], use_jina: bool = False, jina
                 tasks.append(task)
             
             if show_progress:
-                results = []
-                for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Fetching URLs"):
-                    result = await task
-                    results.append(result)
-            else:
-                results = await asyncio.gather(*tasks)
-            
+                # as_completed yields in finish order, so each task carries its own URL
+                async def with_url(url, task):
+                    return url, await task
+
+                contents = {}
+                for task in tqdm(asyncio.as_completed([with_url(url, task) for url, task in zip(urls, tasks)]), total=len(tasks), desc="Fetching URLs"):
+                    url, result = await task
+                    contents[url] = result
+                return contents
+
+            results = await asyncio.gather(*tasks)
             return {url: result for url, result in zip(urls, results)}  
 
     return await process_urls()  